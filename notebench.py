@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package notebench
+#
+#  \brief Benchmark suite of noteorg
+#
+#  A synthetic corpus in the note header format is generated (reproducible
+#  for a given seed), then every stage runs in its own process so that the
+#  reported peak memory belongs to that stage only:
+#
+#  + parse: Note() of every file
+#  + import: updateTree() into an empty database
+#  + resync: updateTree() without any change
+#  + partial: updateTree() after rewriting a share of the files
+#  + tagquery: getFileByTag() with random expressions
+#  + search: NoteDB.search() with random words (if FTS5 is available)
+#
+#  Usage:
+#
+#  > python notebench.py --sizes 1000 10000 --output bench.json <br>
+#  > python notebench.py --sizes 1000 --compare bench.json
+#
+
+import os
+import sys
+import json
+import random
+import bisect
+import shutil
+import argparse
+import resource
+import platform
+import traceback
+import multiprocessing
+from Queue import Empty
+from time import time as now, strftime, localtime
+
+import noteorg
+from systools import *
+
+## words for tags and note bodies
+WORDS = ["python","sql","linux","note","math","physics","music","tea","git",
+         "server","paper","draft","travel","book","idea","todo","class",
+         "design","network","data","plot","shell","editor","family"]
+## characters for Chinese tags and bodies
+HANZI = u"的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研"
+
+##
+# \brief synthetic note corpus
+#
+#  Tags follow a Zipf distribution over a fixed vocabulary, so a few tags
+#  are on most notes and most tags are rare, like in a real collection.
+class Corpus:
+    ##
+    # \brief Initialization code
+    # \param path directory of the corpus
+    # \param count number of notes
+    # \param seed random seed, the same seed gives the same corpus
+    # \param perDir number of notes per sub-directory
+    # \param ntags size of the tag vocabulary
+    # \param nctags size of the Chinese tag vocabulary
+    def __init__(self,path,count,seed=2014,perDir=1000,ntags=2000,nctags=500):
+        ## directory of the corpus
+        self.path = os.path.abspath(path)
+        ## number of notes
+        self.count = count
+        ## random seed
+        self.seed = seed
+        ## number of notes per sub-directory
+        self.perDir = perDir
+        rnd = random.Random(seed)
+        ## tag vocabulary, most frequent first
+        self.tags = ["%s%d"%(rnd.choice(WORDS),i) if i >= len(WORDS) else WORDS[i]
+                     for i in range(ntags)]
+        ## Chinese tag vocabulary, most frequent first
+        self.ctags = []
+        for i in range(nctags):
+            self.ctags.append(u"".join(rnd.choice(HANZI) for j in range(rnd.randint(2,4))))
+        self.__tagWeights = self.__cumulative(ntags)
+        self.__ctagWeights = self.__cumulative(nctags)
+
+    ##
+    # \brief cumulative Zipf weights
+    # \param n number of items
+    def __cumulative(self,n):
+        total = 0.0
+        weights = []
+        for i in range(n):
+            total += 1.0/(i+1)
+            weights.append(total)
+        return weights
+
+    ##
+    # \brief draw distinct items of a vocabulary
+    # \param rnd random generator
+    # \param items vocabulary
+    # \param weights cumulative weights of the vocabulary
+    # \param k number of items
+    def __draw(self,rnd,items,weights,k):
+        drawn = []
+        while len(drawn) < k:
+            item = items[bisect.bisect(weights,rnd.random()*weights[-1])]
+            if item not in drawn:
+                drawn.append(item)
+        return drawn
+
+    ##
+    # \brief file name of a note
+    # \param i index of the note
+    def filename(self,i):
+        return os.path.join(self.path,"d%04d"%(i/self.perDir),"n%07d.md"%i)
+
+    ##
+    # \brief text of a note
+    # \param i index of the note
+    # \param revision revision of the note, changes date, tags and body
+    def text(self,i,revision=0):
+        rnd = random.Random("%d-%d-%d"%(self.seed,i,revision))
+        created = 1262304000+rnd.randint(0,5*365)*86400 # from 2010
+        changed = created+rnd.randint(0,365)*86400
+        tags = self.__draw(rnd,self.tags,self.__tagWeights,rnd.randint(1,6))
+        ctags = self.__draw(rnd,self.ctags,self.__ctagWeights,rnd.randint(0,3))
+        body = []
+        for j in range(rnd.randint(3,40)):
+            words = [rnd.choice(WORDS) for k in range(rnd.randint(5,15))]
+            words.append(u"".join(rnd.choice(HANZI) for k in range(rnd.randint(4,20))))
+            body.append(u" ".join(words))
+        return (u"<!--\n+Author: author%d\n+Date Created: %s\n+Date Changed: %s\n"
+                u"+Tags: %s;\n+标签: %s\n-->\n\n%s\n"
+                %(rnd.randint(0,20),
+                  strftime("%d %b %Y",localtime(created)),
+                  strftime("%d %b %Y",localtime(changed)),
+                  u"; ".join(tags),u"；".join(ctags),u"\n\n".join(body)))
+
+    ##
+    # \brief write a note file
+    # \param i index of the note
+    # \param revision revision of the note
+    def write(self,i,revision=0):
+        filename = self.filename(i)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename,'w') as f:
+            f.write(self.text(i,revision).encode("UTF-8"))
+
+    ##
+    # \brief write the whole corpus, unless already there
+    def generate(self):
+        stamp = os.path.join(self.path,".corpus")
+        if os.path.isfile(stamp) and open(stamp).read() == self.__key():
+            return
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        for i in range(self.count):
+            self.write(i)
+        self.stamp(True)
+
+    ##
+    # \brief mark the files as the generated corpus or not
+    # \param valid if not set, the next generate() writes the corpus again
+    #
+    #  Cleared while some notes are at another revision than 0, so that an
+    #  interrupted run does not leave them to the next one.
+    def stamp(self,valid):
+        stamp = os.path.join(self.path,".corpus")
+        if valid:
+            with open(stamp,'w') as f:
+                f.write(self.__key())
+        elif os.path.isfile(stamp):
+            os.remove(stamp)
+
+    def __key(self):
+        return "%d %d %d\n"%(self.count,self.seed,self.perDir)
+
+##
+# \brief run a stage in a child process
+# \param func stage function, returns a dict of results
+# \param args arguments of func
+# \return dict of results with "seconds" and "peak_rss_kb"
+#
+#  Output of the stage goes to /dev/null, so the per-note messages of
+#  noteorg do not count.  An exception of the stage is raised again here
+#  with its traceback, a stage killed without one raises too.
+def runStage(func,*args):
+    queue = multiprocessing.Queue()
+    def child():
+        sys.stdout = open(os.devnull,'w')
+        try:
+            start = now()
+            result = func(*args)
+            result["seconds"] = now()-start
+            result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            queue.put(("ok",result))
+        except BaseException:
+            queue.put(("error",traceback.format_exc()))
+    proc = multiprocessing.Process(target=child)
+    proc.start()
+    while True:
+        try:
+            status,result = queue.get(timeout=1.0)
+            break
+        except Empty:
+            if not proc.is_alive() and queue.empty():
+                proc.join()
+                raise Exception("!! Stage %s exited with code %s !!"%(func.__name__,proc.exitcode))
+    proc.join()
+    if status == "error":
+        raise Exception("!! Stage %s failed:\n%s !!"%(func.__name__,result))
+    return result
+
+##
+# \brief open the benchmark database, creating it if needed
+def openDB(filename):
+    return noteorg.NoteDB(filename,create=True)
+
+## \brief stage: parse every note
+def stageParse(corpus):
+    n = 0
+    for path,entries in scanTree([corpus.path],("*.md",)):
+        for name in entries:
+            noteorg.Note(path,name)
+            n += 1
+    return {"items": n}
+
+## \brief stage: import into an empty database
+def stageImport(corpus,dbfile,workers):
+    if os.path.isfile(dbfile):
+        os.remove(dbfile)
+    db = openDB(dbfile)
+    db.setBulkMode()
+    db.updateTree([corpus.path],workers=workers)
+    db.cur.execute("SELECT count(*) FROM head")
+    return {"items": db.cur.fetchone()[0]}
+
+## \brief stage: sync without any change
+def stageResync(corpus,dbfile):
+    db = openDB(dbfile)
+    db.updateTree([corpus.path])
+    return {"items": corpus.count}
+
+## \brief stage: sync after rewriting a share of the notes
+#
+#  The notes and the database are put back to revision 0 afterwards, out
+#  of the timing, so the next stages and runs see the generated corpus.
+def stagePartial(corpus,dbfile,share):
+    rnd = random.Random(corpus.seed)
+    changed = rnd.sample(range(corpus.count),max(1,int(corpus.count*share)))
+    corpus.stamp(False)
+    try:
+        for i in changed:
+            corpus.write(i,revision=1)
+        db = openDB(dbfile)
+        start = now()
+        db.updateTree([corpus.path])
+        seconds = now()-start
+    finally:
+        for i in changed:
+            corpus.write(i)
+    db.updateTree([corpus.path])
+    corpus.stamp(True)
+    return {"items": len(changed), "sync_seconds": seconds}
+
+## \brief stage: boolean tag queries
+def stageTagQuery(corpus,dbfile,nquery):
+    db = openDB(dbfile)
+    rnd = random.Random(corpus.seed)
+    hits = 0
+    for i in range(nquery):
+        a,b,c = [rnd.choice(corpus.tags[:200]) for j in range(3)]
+        ctag = rnd.choice(corpus.ctags[:50])
+        expr = rnd.choice([a,"%s %s"%(a,b),"%s OR %s"%(a,b),
+                           "(%s OR %s) NOT %s"%(a,b,c),"%s ctag:%s"%(a,ctag)])
+        hits += len(db.getFileByTag(expr))
+    return {"items": nquery, "hits": hits}
+
+## \brief stage: full-text queries
+def stageSearch(corpus,dbfile,nquery):
+    db = openDB(dbfile)
+    try:
+        db.enableSearch()
+    except Exception as inst:
+        return {"items": 0, "skipped": inst.args[0]}
+    rnd = random.Random(corpus.seed)
+    start = now()
+    hits = 0
+    for i in range(nquery):
+        hits += len(db.search(rnd.choice(WORDS)+" "+rnd.choice(WORDS),limit=20))
+    return {"items": nquery, "hits": hits, "query_seconds": now()-start}
+
+##
+# \brief run all stages for one corpus size
+# \param workdir directory for corpora and databases
+# \param size number of notes
+# \param args parsed command line arguments
+# \return dict of stage: results
+def benchSize(workdir,size,args):
+    corpus = Corpus(os.path.join(workdir,"corpus%d"%size),size,args.seed)
+    start = now()
+    corpus.generate()
+    warning("- corpus of %d notes ready in %.1fs"%(size,now()-start),color=32)
+    dbfile = os.path.join(workdir,"bench%d.db"%size)
+    stages = [("parse",stageParse,(corpus,)),
+              ("import",stageImport,(corpus,dbfile,args.workers)),
+              ("resync",stageResync,(corpus,dbfile)),
+              ("partial",stagePartial,(corpus,dbfile,args.share)),
+              ("tagquery",stageTagQuery,(corpus,dbfile,args.queries)),
+              ("search",stageSearch,(corpus,dbfile,args.queries))]
+    results = {}
+    for name,func,fargs in stages:
+        if args.stages and name not in args.stages:
+            continue
+        result = runStage(func,*fargs)
+        seconds = result.get("query_seconds",result.get("sync_seconds",result["seconds"]))
+        result["per_second"] = result["items"]/seconds if seconds > 0 else None
+        results[name] = result
+        print "%8d %-9s %8d items %9.3fs %10.1f/s %8d KiB"%(
+            size,name,result["items"],seconds,result["per_second"] or 0,result["peak_rss_kb"])
+    return results
+
+##
+# \brief print the ratio of two runs
+# \param old results loaded from a previous run
+# \param new results of this run
+def compare(old,new):
+    print "%8s %-9s %10s %10s %7s"%("size","stage","old/s","new/s","ratio")
+    for size,stages in sorted(new["results"].items(),key=lambda x: int(x[0])):
+        for name,result in sorted(stages.items()):
+            prev = old["results"].get(size,{}).get(name)
+            if prev is None or not prev.get("per_second") or not result.get("per_second"):
+                continue
+            print "%8s %-9s %10.1f %10.1f %6.2fx"%(size,name,prev["per_second"],
+                result["per_second"],result["per_second"]/prev["per_second"])
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark noteorg on synthetic corpora")
+    parser.add_argument("--sizes",type=int,nargs="+",default=[1000,10000],
+                        help="corpus sizes, from 1000 to 1000000 notes")
+    parser.add_argument("--workdir",default="/tmp/notebench",help="directory for corpora and databases")
+    parser.add_argument("--seed",type=int,default=2014,help="corpus random seed")
+    parser.add_argument("--workers",type=int,default=1,help="parsing processes of the import")
+    parser.add_argument("--share",type=float,default=0.01,help="share of notes changed for the partial sync")
+    parser.add_argument("--queries",type=int,default=200,help="number of tag and search queries")
+    parser.add_argument("--stages",nargs="*",help="run only these stages")
+    parser.add_argument("--output",help="write the results to this JSON file")
+    parser.add_argument("--compare",help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    report = {"time": strftime("%Y-%m-%d %H:%M:%S"),
+              "python": platform.python_version(),
+              "sqlite": noteorg.sql.sqlite_version,
+              "args": vars(args),
+              "results": {}}
+    for size in args.sizes:
+        report["results"][str(size)] = benchSize(args.workdir,size,args)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=2,sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f),report)
+
+if __name__=="__main__":
+    main()
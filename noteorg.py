@@ -28,14 +28,36 @@
 #  > "content": xxx <br>
 #  > }
 #
+#  NoteDB.exportJSON() writes one object per line (JSONL) with the dates
+#  as YYYY-MM-DD and also "filename", "path", "Date_modified" (system
+#  modification time, YYYY-MM-DD HH:MM:SS) and "manifest" ({"size", "mtime",
+#  "hash"} of the file, or null).
+#
 
 
-from os.path import isfile,abspath,basename,getmtime
+from os.path import isfile,isdir,abspath,basename,getmtime
+import os
 import sys
 import sqlite3 as sql
 import glob
 import re
+import multiprocessing
+import argparse
+import heapq
+import cProfile
+import pstats
+from StringIO import StringIO
+import zlib
+import gzip
+import json
+import hashlib
+import select
+import errno
+import struct
+import ctypes
+import ctypes.util
 from time import localtime, strftime,strptime
+from time import time as now
 
 from systools import *
 
@@ -43,17 +65,203 @@ from systools import *
 reload(sys)
 sys.setdefaultencoding("UTF-8")
 
+##
+# \brief time and count per stage of an ingest run
+#
+#  Stages (times of nested stages are included in the outer one):
+#
+#  + scan: listing directories
+#  + manifest: comparing stat results with the manifest
+#  + load: getting the next Note, i.e. read + parse for serial parsing,
+#    waiting for the worker processes otherwise
+#  + read: reading whole files or the lazy content
+#  + parse: parsing the text, or streaming the header of headerOnly Notes
+#  + strptime: parsing dates
+#  + write: insertNote/updateNote
+#  + tagsql: tag and bridge statements
+#  + commit: commits
+#
+#  read, parse and strptime are not seen in the worker processes.
+class IngestStats:
+    ##
+    # \brief Initialization code
+    # \param slowest number of slowest files to keep (and to re-parse under
+    #   cProfile in profileSlowest())
+    def __init__(self,slowest=0):
+        ## stage: seconds
+        self.seconds = {}
+        ## stage: number of calls
+        self.counts = {}
+        ## number of slowest files to keep
+        self.slowest = slowest
+        ## heap of (seconds, path, filename) of the slowest files
+        self.files = []
+        ## filename: cProfile statistics text
+        self.profiles = {}
+        ## start time of the run
+        self.start = now()
+
+    ##
+    # \brief record a stage
+    # \param stage name of the stage
+    # \param seconds time spent
+    # \param count number of items
+    def add(self,stage,seconds,count=1):
+        self.seconds[stage] = self.seconds.get(stage,0.0)+seconds
+        self.counts[stage] = self.counts.get(stage,0)+count
+
+    ##
+    # \brief record the time spent on a file (load and write)
+    def addFile(self,path,filename,seconds):
+        if self.slowest <= 0:
+            return
+        if len(self.files) < self.slowest:
+            heapq.heappush(self.files,(seconds,path,filename))
+        elif seconds > self.files[0][0]:
+            heapq.heapreplace(self.files,(seconds,path,filename))
+
+    ##
+    # \brief parse the slowest files again under cProfile
+    def profileSlowest(self):
+        for seconds,path,filename in self.files:
+            prof = cProfile.Profile()
+            try:
+                prof.runcall(Note,path,filename)
+            except Exception:
+                pass
+            out = StringIO()
+            pstats.Stats(prof,stream=out).sort_stats("cumulative").print_stats(15)
+            self.profiles[path+filename] = out.getvalue()
+
+    ##
+    # \brief text table of the stages
+    def report(self):
+        total = now()-self.start
+        lines = ["%-10s %10s %8s %10s"%("stage","seconds","share","count")]
+        for stage in sorted(self.seconds,key=self.seconds.get,reverse=True):
+            lines.append("%-10s %10.3f %7.1f%% %10d"%(stage,self.seconds[stage],
+                         100*self.seconds[stage]/total if total else 0,self.counts[stage]))
+        lines.append("%-10s %10.3f"%("total",total))
+        for seconds,path,filename in sorted(self.files,reverse=True):
+            lines.append("%8.4fs %s%s"%(seconds,path,filename))
+            if path+filename in self.profiles:
+                lines.append(self.profiles[path+filename])
+        return NEWLINE.join(lines)
+
+## IngestStats of the running profile, None when profiling is off
+_profile = None
+
+##
+# \brief start recording ingest statistics
+# \param slowest number of slowest files to profile with cProfile at the end
+# \return the IngestStats
+def startProfile(slowest=0):
+    global _profile
+    _profile = IngestStats(slowest)
+    return _profile
+
+##
+# \brief stop recording ingest statistics
+# \return the IngestStats, with cProfile of the slowest files
+def stopProfile():
+    global _profile
+    stats,_profile = _profile,None
+    if stats is not None:
+        stats.profileSlowest()
+    return stats
+
+## memo of _parseDate(), the same dates come back in many headers
+_DATES = {}
+
+##
+# \brief parse a header date
+# \param text date as "%d %b %Y"
+#
+#  strptime() is slow, so every date string is parsed only once.
+def _parseDate(text):
+    date = _DATES.get(text)
+    if date is not None:
+        return date
+    start = now() if _profile is not None else None
+    date = strptime(text,"%d %b %Y")
+    if start is not None:
+        _profile.add("strptime",now()-start)
+    if len(_DATES) >= 100000:
+        _DATES.clear()
+    _DATES[text] = date
+    return date
+
+## separators of the tags of a header
+_TAGSEP = re.compile(';+')
+## separators of the ctags of a header, half and full width
+_CTAGSEP = re.compile(';+|；+')
+## tokens of a tag expression: parentheses, quoted tags, words, and a
+#  lone quote left unterminated
+_TAGTOKEN = re.compile(r'\(|\)|(?:c?tag:)?"[^"]*"\*?|[^\s()"]+"?|"',re.UNICODE)
+## FTS5 query syntax, a query using it is passed to MATCH as it is
+_FTSSYNTAX = re.compile(u'["()*:^+{}]|(^|\\s)(AND|OR|NOT|NEAR)(\\s|$)',re.UNICODE)
+
+##
+# \brief split a full-text query in words FTS5 can match and short words
+# \param query the query
+# \return (MATCH string or None, list of words shorter than 3 characters)
+#
+#  The trigram tokenizer cannot match words shorter than 3 characters,
+#  like most Chinese words, and unicode61 matches only whole runs of
+#  Chinese characters.  Such words of a plain query (words separated by
+#  spaces, all required) are returned apart to be matched with LIKE.
+def _splitQuery(query):
+    query = unicode(query)
+    if _FTSSYNTAX.search(query):
+        return query,[]
+    words = query.split()
+    match = " ".join(word for word in words if len(word) >= 3)
+    return match or None,[word for word in words if len(word) < 3]
+
+##
+# \brief split a text in lines like readlines()
+# \param text the text
+def _splitLines(text):
+    lines = [line+NEWLINE for line in text.split(NEWLINE)]
+    if lines[-1] == NEWLINE:
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+## pool of tag strings shared by all Notes, see internTag()
+_TAGPOOL = {}
+
+##
+# \brief share one string object between equal tags
+# \param tag tag string
+# \return the pooled tag string
+#
+#  intern() of python 2 does not take unicode, so a dict is used instead.
+def internTag(tag):
+    return _TAGPOOL.setdefault(tag,tag)
+
 ##
 #  \brief Class for markdown file note
 #  \details This class build to load the file into program and support multiple output formats
 #  \date 2014-01-17
-class Note:
+class Note(object):
+    __slots__ = ("filename","path","author","dateCreate","dateChange",
+                 "modifyTime","tags","ctags","_content","_offset")
+
     ##
     # \brief Initialization code
     # \param path path to the file (the last */* is needed)
     # \param filename name string of a file to load-in
     # \param fulltext if set, then create the Note from input text
-    def __init__(self,path,filename,fulltext=[]):
+    # \param headerOnly if set, stop reading the file at the end of the header,
+    #   the content is then read on first access
+    # \param mtime modification time of the file if already known from a stat
+    def __init__(self,path,filename,fulltext=[],headerOnly=False,mtime=None):
+        ## Main content of the Note, None until loaded
+        self._content = None
+        ## byte offset of the content in the file
+        self._offset = None
         try:
             ## Filename of the Note
             self.filename = unicode(filename)
@@ -65,8 +273,10 @@ class Note:
             filename = self.path+self.filename
             if len(fulltext) == 0: # create new Note from file
                 # !!! Exam file existency !!! #
-                if not isfile(filename):
-                    raise Exception("!! Fail to open %s !!"%filename)
+                if mtime is None:
+                    if not isfile(filename):
+                        raise Exception("!! Fail to open %s !!"%filename)
+                    mtime = getmtime(filename)
                 # !!! initial empty content !!! #
                 ## Author of the Note 
                 self.author = unicode("EMPTY")
@@ -75,39 +285,139 @@ class Note:
                 ## Create Date of the Note
                 self.dateChange = None
                 ## system last modification time
-                self.modifyTime = localtime(getmtime(filename))
+                self.modifyTime = localtime(mtime)
                 ## Tags for the Note
                 self.tags = []
                 ## Tags for the Note (Chinese)
                 self.ctags = []
-                ## Main content of the Note
                 self.content = ''
-                # !!! Load file content !!! #
-                with open(filename,'r') as f:
-                    fulltext = f.readlines()
+                start = now() if _profile is not None else None
+                try:
+                    if headerOnly: # !!! Load header only !!! #
+                        self.__loadHeader(filename)
+                        if start is not None:
+                            _profile.add("parse",now()-start)
+                        return
+                    # !!! Load file content !!! #
+                    with open(filename,'r') as f:
+                        text = f.read()
+                    if start is not None:
+                        _profile.add("read",now()-start)
+                except IOError:
+                    raise Exception("!! Fail to open %s !!"%filename)
                     # !!! empty file case !!! #
-                if len(fulltext) == 0:
+                if len(text) == 0:
                     raise Exception("!! File %s is empty"%filename)
+                start = now() if _profile is not None else None
+                offset = self.__phraseBuffer(text)
+                if offset is None: # header not in the usual form
+                    self.phraseContent(_splitLines(text))
+                elif offset == len(text):
+                    raise Exception("!! Empty Content !!")
+                else:
+                    self.content = unicode(text[offset:])
+                if start is not None:
+                    _profile.add("parse",now()-start)
+                return
             else: # the fulltext is loaded from database
                 # !!! empty Database case !!! #
                 if len(fulltext) == 0:
                     raise Exception("!! Database item %s is empty"%filename)
             # !!! phrasing content !!! #
+            start = now() if _profile is not None else None
             self.phraseContent(fulltext)
+            if start is not None:
+                _profile.add("parse",now()-start)
         except Exception as inst:
             warning("!!Note"+inst.args[0])
             if inst.args[0][:2] == "!!":
                 raise Exception("NoteClass","!!Fail to initialize Note class from %s"%self.filename)
             else:
                 raise
+
+    ##
+    # \brief Main content of the Note
+    #
+    #  A Note created with headerOnly reads its content from the file here.
+    @property
+    def content(self):
+        if self._content is None and self._offset is not None:
+            start = now() if _profile is not None else None
+            with open(self.path+self.filename,'r') as f:
+                f.seek(self._offset)
+                self._content = unicode(f.read())
+            if start is not None:
+                _profile.add("read",now()-start)
+        return self._content
+
+    @content.setter
+    def content(self,value):
+        self._content = value
+
+    ##
+    # \brief stream the header of a file and remember where the content starts
+    # \param filename full name of the file
+    def __loadHeader(self,filename):
+        with open(filename,'r') as f:
+            # !!! usually the whole header is in the first block !!! #
+            block = f.read(4096)
+            offset = self.__phraseBuffer(block)
+            if offset is not None:
+                self._offset = offset
+                if offset == len(block) and f.read(1) == '':
+                    raise Exception("!! Empty Content !!")
+                self._content = None
+                return
+            f.seek(0)
+            lines = iter(f.readline,'') # keep f.tell() exact
+            first = next(lines,'')
+            # !!! empty file case !!! #
+            if first == '':
+                raise Exception("!! File %s is empty"%filename)
+            self.__phraseHeader(first,lines)
+            self._offset = f.tell()
+            if f.readline() == '':
+                raise Exception("!! Empty Content !!")
+        self._content = None
+
+    ##
+    # \brief phrase the header at the beginning of a buffer
+    # \param text beginning of the file
+    # \return offset of the content in text, None if text does not start
+    #   with a complete "<!--" ... "-->" header
+    #
+    #  Only the header lines are split, the content stays in one piece.
+    def __phraseBuffer(self,text):
+        if not text.startswith("<!--\n"):
+            return None
+        end = text.find("\n-->\n")
+        if end < 0:
+            return None
+        lines = [line+NEWLINE for line in text[5:end+1].split(NEWLINE)]
+        lines[-1] = "-->\n"
+        self.__phraseHeader(text[:5],iter(lines))
+        return end+5
+
     ##
     # \brief phrase the whole content
     def phraseContent(self,fulltext):
-        if fulltext[0].strip(NEWLINE) != "<!--":
+        ii = self.__phraseHeader(fulltext[0],iter(fulltext[1:]))
+        # !!! insert main body !!! #
+        if len(fulltext) == ii+2:
+            raise Exception("!! Empty Content !!")
+        self.content = unicode("".join(fulltext[ii+2:]))
+
+    ##
+    # \brief phrase the header lines
+    # \param first the first line of the text
+    # \param lines iterator of the following lines, consumed up to "-->"
+    # \return number of header lines between "<!--" and "-->"
+    def __phraseHeader(self,first,lines):
+        if first.strip(NEWLINE) != "<!--":
             raise Exception("!! Fail to recognize header from: %s"
-                            %fulltext[0].strip(NEWLINE))
+                            %first.strip(NEWLINE))
         finishFlag = False
-        for ii,line in enumerate(fulltext[1:]):
+        for ii,line in enumerate(lines):
             if (line.strip(NEWLINE) == "-->"):
                 finishFlag = ii
                 break
@@ -132,41 +442,39 @@ class Note:
                 warning("unknown case:: %s"%line)
         if not finishFlag:
             raise Exception("!! Unfinished header !!")
-        # !!! insert main body !!! #
-        if len(fulltext) == ii+2:
-            raise Exception("!! Empty Content !!")
-        self.content = unicode("".join(fulltext[ii+2:]))
+        return finishFlag
 
     ##
     # \brief Populate the header content into Note class
     # \param name the keyword
     # \param content string contains all keywords
     def __populateHeaderObj(self,name,content):
-        content = content.strip() # remove leading and trailing spaces
-        if name.lower() == "author": 
-            self.author = unicode(content)
-        if name.lower() == "date created":
-            if content == "":
-                self.dateCreate = localtime()
-            else:
-                self.dateCreate = strptime(content,"%d %b %Y")
-        if name.lower() == "date changed":
-            if content == "":
-                self.dateChange = self.dateCreate
-            else:
-                self.dateChange = strptime(content,"%d %b %Y")
-        if name.lower() == "tags":
-            self.__populateTagArray(content)
-        if name.lower() == "标签":
-            self.__populateTagArrayS(content)
+        setter = self.__HEADERS.get(name.lower())
+        if setter is not None:
+            setter(self,content.strip()) # remove leading and trailing spaces
         return
 
+    def __populateAuthor(self,content):
+        self.author = unicode(content)
+
+    def __populateDateCreate(self,content):
+        if content == "":
+            self.dateCreate = localtime()
+        else:
+            self.dateCreate = _parseDate(content)
+
+    def __populateDateChange(self,content):
+        if content == "":
+            self.dateChange = self.dateCreate
+        else:
+            self.dateChange = _parseDate(content)
+
     ##
     # \brief Populate the header tags array, work only for or ";"
     # \param content a ;-seperated list of tags
     def __populateTagArray(self,content):
-        self.tags = re.split(';+', content)
-        self.tags = [unicode(x.strip().capitalize()) for x in self.tags if x]
+        self.tags = _TAGSEP.split(content)
+        self.tags = [internTag(unicode(x.strip().capitalize())) for x in self.tags if x]
         return
     
     ##
@@ -174,9 +482,19 @@ class Note:
     # \param content a ;-seperated list of tags
     #  Populate the header tag array, work only for  or ";"
     def __populateTagArrayS(self,content):
-        self.ctags = re.split(';+|；+', content)
-        self.ctags = [unicode(x.strip().capitalize()) for x in self.ctags if x]
+        self.ctags = _CTAGSEP.split(content)
+        self.ctags = [internTag(unicode(x.strip().capitalize())) for x in self.ctags if x]
         return 
+
+    ## lowercased header name: method populating it, the name of a header
+    #  read as unicode has to match too
+    __HEADERS = {"author": __populateAuthor,
+                 "date created": __populateDateCreate,
+                 "date changed": __populateDateChange,
+                 "tags": __populateTagArray,
+                 "标签": __populateTagArrayS,
+                 u"标签": __populateTagArrayS}
+
     ##
     # \brief return header information in one string
     def returnHeader(self):
@@ -203,14 +521,278 @@ class Note:
             raise
             #sys.exit(1)
         return
+
+    ##
+    # \brief create a Note from a JSON object, see NoteDB.exportJSON()
+    # \param obj dict of the JSON object
+    # \return Note
+    #
+    #  Nothing is read from the file of the Note.
+    @staticmethod
+    def fromJSON(obj):
+        note = Note.__new__(Note)
+        note.filename = unicode(obj["filename"])
+        note.path = unicode(obj["path"])
+        note.author = unicode(obj["Author"])
+        note.dateCreate = strptime(obj["Date_create"],"%Y-%m-%d")
+        note.dateChange = strptime(obj["Date_change"],"%Y-%m-%d")
+        note.modifyTime = strptime(obj["Date_modified"],"%Y-%m-%d %H:%M:%S")
+        note.tags = [internTag(unicode(x)) for x in obj["tags"]]
+        note.ctags = [internTag(unicode(x)) for x in obj["ctags"]]
+        note._content = unicode(obj["content"])
+        note._offset = None
+        return note
+
+##
+# \brief load a Note for the ingest pipeline
+# \param args tuple of (path, filename, headerOnly, mtime or None)
+# \return tuple of (filename, Note or None, error message or None)
+#
+#  It lives at module level so that multiprocessing can pickle it.
+def _loadNote(args):
+    path,ifile,headerOnly,mtime = args
+    try:
+        return (ifile,Note(path,ifile,headerOnly=headerOnly,mtime=mtime),None)
+    except Exception as inst:
+        if (len(inst.args) == 2) and (inst.args[0]=="NoteClass"): # read-in fail
+            return (ifile,None,inst.args[1])
+        raise
+
+##
+# \brief map a function over jobs in a process pool, keeping the order
+# \param func function of one job, at module level to be pickled
+# \param jobs iterable of jobs, consumed as results are taken
+# \param workers number of processes, 1 to run in the calling process
+# \param ahead number of jobs queued per process
+# \return generator of the results
+#
+#  Unlike Pool.imap, only workers*ahead jobs and results are held at a time.
+def _orderedMap(func,jobs,workers=1,ahead=2):
+    if workers <= 1:
+        for job in jobs:
+            yield func(job)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = []
+        for job in jobs:
+            pending.append(pool.apply_async(func,(job,)))
+            if len(pending) >= workers*ahead:
+                yield pending.pop(0).get()
+        while pending:
+            yield pending.pop(0).get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+##
+# \brief open a JSONL file to read, gzip compressed if the name ends with .gz
+# \param filename name of the file
+def _openJSON(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename,"rb")
+    return open(filename,"rb")
+
+##
+# \brief content text of a content row
+# \param text content column
+# \param data blob data, None for plain text
+def _readContent(text,data):
+    if data is None:
+        return text
+    return unicode(zlib.decompress(str(data)),"UTF-8")
+
+##
+# \brief export the Notes of a fid range as JSONL
+# \param args tuple of (database file, first fid, last fid + 1, compress)
+# \return tuple of (number of Notes, JSONL text), the text is a gzip
+#   member if compress is set
+#
+#  Each call opens its own connection so that ranges can be read by
+#  several processes at once.  Concatenated gzip members are a valid
+#  gzip file, so the compression runs in the processes too.
+def _exportRange(args):
+    filename,first,last,compress = args
+    conn = sql.connect(filename)
+    try:
+        cur = conn.cursor()
+        tags = {}
+        for kind,(table,idcol,bridge) in NoteDB.TAGTABLES.items():
+            tags[kind] = {}
+            cur.execute("SELECT fid, %s FROM %s JOIN %s USING (%s) WHERE fid >= ? AND fid < ? ORDER BY fid, %s"
+                        %(kind,bridge,table,idcol,idcol),[first,last])
+            for fid,itag in cur:
+                tags[kind].setdefault(fid,[]).append(itag)
+        cur.execute('''SELECT fid, filename, path, author, date_create, date_change, sys_modified,
+        content, data, size, mtime, manifest.hash FROM head JOIN content USING (fid)
+        LEFT JOIN blob USING (bid) LEFT JOIN manifest USING (fid)
+        WHERE fid >= ? AND fid < ? ORDER BY fid''',[first,last])
+        lines = []
+        for row in cur:
+            fid = row[0]
+            lines.append(json.dumps({
+                "filename": row[1], "path": row[2], "Author": row[3],
+                "Date_create": row[4], "Date_change": row[5], "Date_modified": row[6],
+                "tags": tags["tag"].get(fid,[]), "ctags": tags["ctag"].get(fid,[]),
+                "content": _readContent(row[7],row[8]),
+                "manifest": None if row[9] is None else
+                    {"size": row[9], "mtime": row[10], "hash": row[11]},
+                },ensure_ascii=False).encode("UTF-8"))
+        lines.append("")
+        text = "\n".join(lines)
+        if compress:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf,mode="wb",compresslevel=6) as f:
+                f.write(text)
+            text = buf.getvalue()
+        return (len(lines)-1,text)
+    finally:
+        conn.close()
+
+##
+# \brief decode a chunk of JSONL lines
+# \param lines list of lines
+# \return list of dict
+def _parseJSON(lines):
+    return [json.loads(line) for line in lines if line.strip()]
+
+##
+# \brief read a file in chunks of lines
+# \param f file object
+# \param size number of lines per chunk
+# \return generator of list of lines
+def _readChunks(f,size):
+    chunk = []
+    for line in f:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
                
 ## 
 # \class IndexPage
 # \brief index all Note classes
 # 
 # Create an index page contains all tags and filename(link)
+#
+#  The index is a directory of markdown pages:
+#
+#  + index.md: all tags, ctags and months with links to their pages
+#  + tag/<tag>.md, ctag/<ctag>.md: files of a tag, newest first
+#  + date/<YYYY-MM>.md: files changed in a month
+#
+#  The NoteDB generation of the last build is kept in the directory, a
+#  later build only renders the pages whose section changed since then.
 class IndexPage:
-    pass
+    ## file keeping the generation of the last build
+    STATEFILE = ".generation"
+
+    ##
+    # \brief Initialization code
+    # \param db a NoteDB
+    # \param path output directory of the index
+    def __init__(self,db,path):
+        ## NoteDB to index
+        self.db = db
+        ## output directory
+        self.path = abspath(path)+'/'
+
+    ##
+    # \brief build the index, only the changed pages unless full is set
+    # \param full if set, render every page
+    # \return number of pages written or removed
+    def build(self,full=False):
+        gen = self.db.generation
+        last = self.__lastGeneration()
+        cur = self.db.cur
+        if full or last is None:
+            sections = [("tag",row[0]) for row in self.db.listTags("tag")]
+            sections.extend(("ctag",row[0]) for row in self.db.listTags("ctag"))
+            cur.execute("SELECT DISTINCT substr(date_change,1,7) FROM head")
+            sections.extend(("date",row[0]) for row in cur.fetchall())
+            for section in ("tag","ctag","date"):
+                self.__clear(section)
+        else:
+            cur.execute("SELECT section, name FROM index_dirty WHERE gen > ? AND gen <= ?",[last,gen])
+            sections = cur.fetchall()
+        for section,name in sections:
+            self.__renderSection(section,name)
+        if sections or full or last is None:
+            self.__renderIndex()
+        with open(self.path+self.STATEFILE,'w') as f:
+            f.write("%d\n"%gen)
+        return len(sections)
+
+    ##
+    # \brief generation of the last build, None if never built
+    def __lastGeneration(self):
+        if not isfile(self.path+self.STATEFILE):
+            return None
+        with open(self.path+self.STATEFILE,'r') as f:
+            return int(f.read().strip())
+
+    ##
+    # \brief file name of a section page
+    # \param section "tag", "ctag" or "date"
+    # \param name tag or month
+    def pageName(self,section,name):
+        return "%s/%s.md"%(section,unicode(name).replace('/','_'))
+
+    ##
+    # \brief remove all pages of a section
+    def __clear(self,section):
+        for ifile in glob.glob(self.path+section+"/*.md"):
+            os.remove(ifile)
+
+    ##
+    # \brief render the page of one tag, ctag or month, remove it if empty
+    # \param section "tag", "ctag" or "date"
+    # \param name tag or month
+    def __renderSection(self,section,name):
+        cur = self.db.cur
+        if section == "date":
+            title = "Date: %s"%name
+            cur.execute('''SELECT filename, path, date_change FROM head
+            WHERE substr(date_change,1,7) = ? ORDER BY date_change DESC, filename''',[name])
+        else:
+            table,idcol,bridge = self.db.TAGTABLES[section]
+            title = "%s: %s"%("Tag" if section == "tag" else "标签",name)
+            cur.execute('''SELECT filename, path, date_change FROM head
+            JOIN %s USING (fid) JOIN %s USING (%s) WHERE %s = ?
+            ORDER BY date_change DESC, filename'''%(bridge,table,idcol,section),[name])
+        rows = cur.fetchall()
+        filename = (self.path+self.pageName(section,name)).encode("UTF-8")
+        if not rows:
+            if isfile(filename):
+                os.remove(filename)
+            return
+        if not isdir(self.path+section):
+            os.makedirs(self.path+section)
+        lines = ["# %s"%title,""]
+        lines.extend("+ %s [%s](%s%s)"%(row[2],row[0],row[1],row[0]) for row in rows)
+        with open(filename,'w') as f:
+            f.write(NEWLINE.join(lines)+NEWLINE)
+
+    ##
+    # \brief render index.md
+    def __renderIndex(self):
+        lines = []
+        for section,title in (("tag","Tags"),("ctag","标签")):
+            lines.extend(["# %s"%title,""])
+            lines.extend("+ [%s](%s) (%d)"%(name,self.pageName(section,name),count)
+                         for name,count in self.db.listTags(section))
+            lines.append("")
+        self.db.cur.execute("SELECT substr(date_change,1,7), count(*) FROM head GROUP BY 1 ORDER BY 1 DESC")
+        lines.extend(["# Date",""])
+        lines.extend("+ [%s](%s) (%d)"%(month,self.pageName("date",month),count)
+                     for month,count in self.db.cur.fetchall())
+        if not isdir(self.path):
+            os.makedirs(self.path)
+        with open(self.path+"index.md",'w') as f:
+            f.write(NEWLINE.join(lines)+NEWLINE)
                         
 ##
 # \class NoteDB
@@ -226,8 +808,16 @@ class IndexPage:
 #
 #  + import(): import a new path into database (no file conflict checking)
 #  + update(): update a path which contains files already in database
+#  + deleteNote(): remove a Note and its tags from database
 #  + getFileByTag():  get file names by tag
+#  + getFileByDate(): get file names by a date range
+#  + changedSince(): Notes changed since a generation
 #  + getContent(): get file content by file name
+#  + setContentStorage(): store contents compressed and deduplicated
+#  + search(): full-text search of the content
+#  + listTags(): tags in use with their number of Notes
+#  + commit(): commit pending writes as a new generation
+#  + cacheStats(): hit/miss counters of the read cache
 #
 #  ### Database entry
 #  
@@ -245,9 +835,15 @@ class IndexPage:
 #   | date_create  | TEXT                |
 #   | date_change  | TEXT                |
 #   | sys_modified | TEXT                |
+#   | gen          | INTEGER             |
 #   --------------------------------------
 #
 #        UNIQUE (filename,path)
+#        INDEX head_path (path)
+#        INDEX head_date_create, head_date_change, head_sys_modified, head_gen
+#
+#        dates are ISO strings ("YYYY-MM-DD", "YYYY-MM-DD HH:MM:SS"), so
+#        their order is the chronological order
 #
 #   + content
 #
@@ -256,8 +852,24 @@ class IndexPage:
 #   |---------|----------------------------------------------|
 #   | fid     | INTEGER NOT NULL PRIMARY KEY REFERENCES head |
 #   | content | TEXT                                         |
+#   | bid     | INTEGER REFERENCES blob                      |
+#   ----------------------------------------------------------
+#
+#        content is NULL and bid is set with the "zlib" storage
+#
+#   + blob
+#
+#   ----------------------------------------------------------
+#   | Name    | Type                                         |
+#   |---------|----------------------------------------------|
+#   | bid     | INTEGER PRIMARY KEY                          |
+#   | hash    | TEXT UNIQUE                                  |
+#   | data    | BLOB                                         |
+#   | refs    | INTEGER                                      |
 #   ----------------------------------------------------------
 #
+#        zlib compressed content shared by the Notes with the same SHA-1
+#
 #   + tag
 #
 #   ----------------------------------------------------------
@@ -265,6 +877,7 @@ class IndexPage:
 #   |--------|-----------------------------------------------|
 #   | tid | INTEGER NOT NULL PRIMARY KEY                     |
 #   | tag | TEXT UNIQUE                                      |
+#   | refs | INTEGER, number of Notes with the tag           |
 #   ----------------------------------------------------------
 #
 #   + ctag
@@ -274,6 +887,7 @@ class IndexPage:
 #   |--------|-----------------------------------------------|
 #   |ctid |INTEGER NOT NULL PRIMARY KEY|
 #   |ctag |TEXT UNIQUE|
+#   |refs |INTEGER, number of Notes with the ctag|
 #   --------------------
 #
 #   + tf_bridge
@@ -286,6 +900,7 @@ class IndexPage:
 #   ----------------------------------------------------------
 #
 #        PRIMARY KEY (fid,tid)
+#        INDEX tf_bridge_tid (tid)
 #
 #   + ctf_bridge
 #
@@ -297,19 +912,103 @@ class IndexPage:
 #   ----------------------------------------------------------
 #
 #        PRIMARY KEY (fid,ctid)
+#        INDEX ctf_bridge_ctid (ctid)
+#
+#   + manifest
+#
+#   ----------------------------------------------------------
+#   | Name   | Type                                          |
+#   |--------|-----------------------------------------------|
+#   | fid    | INTEGER NOT NULL PRIMARY KEY REFERENCES head  |
+#   | size   | INTEGER                                       |
+#   | mtime  | REAL                                          |
+#   | hash   | TEXT                                          |
+#   ----------------------------------------------------------
+#
+#        file state when the Note was last read, used to skip unchanged files
+#
+#   + meta
+#
+#        key / value store, e.g. "generation" of the last commit with writes,
+#        "next_fid" of the next new Note (fids are never reused)
+#
+#   + index_dirty
+#
+#   ----------------------------------------------------------
+#   | Name    | Type                                         |
+#   |---------|----------------------------------------------|
+#   | section | TEXT                                         |
+#   | name    | TEXT                                         |
+#   | gen     | INTEGER                                      |
+#   ----------------------------------------------------------
+#
+#        PRIMARY KEY (section,name)
+#        last generation that changed a "tag", "ctag" or "date" (month)
+#        section of IndexPage
+#
+#   + deleted
+#
+#   ----------------------------------------------------------
+#   | Name     | Type                                        |
+#   |----------|---------------------------------------------|
+#   | fid      | INTEGER                                     |
+#   | filename | TEXT                                        |
+#   | path     | TEXT                                        |
+#   | gen      | INTEGER                                     |
+#   ----------------------------------------------------------
+#
+#        INDEX deleted_gen (gen)
+#        Notes removed by deleteNote(), for changedSince()
+#
+#   + note_fts (optional, see enableSearch())
+#
+#        FTS5 virtual table of the content, rowid is the fid of the Note
 #
 class NoteDB():
+    ## tag kind: (tag table, id column, bridge table)
+    TAGTABLES = {"tag": ("tag","tid","tf_bridge"),
+                 "ctag": ("ctag","ctid","ctf_bridge")}
+
     ## 
     # initialize the NoteDB class
     #  \param filename file name of the database
     #    if file exist, then read the database, otherwise ask to create one
-    def __init__(self,filename):
-        if isfile(filename):
+    #  \param create if set, create a missing database without asking
+    #  \param cacheItems maximum number of cached read results
+    #  \param cacheBytes maximum estimated size of cached read results
+    #  \param readonly if set, open an existing database for queries only,
+    #    the connection may then be used from any thread (one at a time)
+    def __init__(self,filename,create=False,cacheItems=1024,cacheBytes=16<<20,
+                 readonly=False):
+        ## tag kind: {tag: id} cache of the tag tables
+        self.__tagCache = {}
+        ## tag kind: PrefixIndex of suggestTags(), built on first use
+        self.__tagIndex = {}
+        ## whether there are uncommitted writes, see commit()
+        self.__dirty = False
+        ## number of writes, invalidates the result cache
+        self.__changes = 0
+        ## LRU cache of getContent(), listTags(), getFileByTag() and search()
+        self.cache = LRUCache(cacheItems,cacheBytes)
+        ## whether the database is opened for queries only
+        self.readonly = readonly
+        if readonly:
+            if not isfile(filename):
+                raise Exception("!! Database %s does not exist !!"%filename)
+            self.conn = sql.connect(filename,check_same_thread=False)
+            self.conn.text_factory = str
+            self.cur = self.conn.cursor()
+            self.cur.execute("PRAGMA query_only = 1")
+            self.__loadState()
+        elif isfile(filename):
             ## SQL connector
             self.conn = sql.connect(filename)
             self.conn.text_factory = str
             ## SQL cursor
             self.cur = self.conn.cursor() 
+            self.__migrateDB()
+        elif create:
+            self.__createDB(filename)
         else:
             s = raw_input(">> Create a database '%s'? [n]/y: "%filename)
             if s != 'y':
@@ -370,144 +1069,1247 @@ class NoteDB():
         PRIMARY KEY (fid,ctid)
         )
         ''')
-        self.conn.commit()
         self.cur = c
+        self.__migrateDB()
+
+    ##
+    # \brief bring a database created by an older version up to date
+    #
+    #  Every statement must be safe to run on an up-to-date database.
+    def __migrateDB(self):
+        self.cur.executescript(''' CREATE TABLE IF NOT EXISTS manifest
+        (
+        fid INTEGER NOT NULL PRIMARY KEY REFERENCES head,
+        size INTEGER,
+        mtime REAL,
+        hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS head_path ON head (path);
+        CREATE INDEX IF NOT EXISTS tf_bridge_tid ON tf_bridge (tid);
+        CREATE INDEX IF NOT EXISTS ctf_bridge_ctid ON ctf_bridge (ctid);
+        CREATE TABLE IF NOT EXISTS meta
+        (
+        key TEXT PRIMARY KEY,
+        value
+        );
+        CREATE TABLE IF NOT EXISTS index_dirty
+        (
+        section TEXT,
+        name TEXT,
+        gen INTEGER,
+        PRIMARY KEY (section,name)
+        );
+        CREATE TABLE IF NOT EXISTS blob
+        (
+        bid INTEGER PRIMARY KEY,
+        hash TEXT UNIQUE,
+        data BLOB,
+        refs INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS deleted
+        (
+        fid INTEGER,
+        filename TEXT,
+        path TEXT,
+        gen INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS deleted_gen ON deleted (gen);
+        CREATE INDEX IF NOT EXISTS head_date_create ON head (date_create);
+        CREATE INDEX IF NOT EXISTS head_date_change ON head (date_change);
+        CREATE INDEX IF NOT EXISTS head_sys_modified ON head (sys_modified)
+        ''')
+        self.cur.execute("PRAGMA table_info(head)")
+        if "gen" not in [row[1] for row in self.cur.fetchall()]:
+            self.cur.execute("ALTER TABLE head ADD COLUMN gen INTEGER DEFAULT 0")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS head_gen ON head (gen)")
+        for kind,(table,idcol,bridge) in self.TAGTABLES.items():
+            self.cur.execute("PRAGMA table_info(%s)"%table)
+            if "refs" not in [row[1] for row in self.cur.fetchall()]:
+                self.cur.execute("ALTER TABLE %s ADD COLUMN refs INTEGER DEFAULT 0"%table)
+                self.cur.execute("UPDATE %s SET refs = (SELECT count(*) FROM %s WHERE %s.%s = %s.%s)"
+                                 %(table,bridge,bridge,idcol,table,idcol))
+            self.cur.execute("CREATE INDEX IF NOT EXISTS %s_refs ON %s (refs)"%(table,table))
+        self.cur.execute("PRAGMA table_info(content)")
+        if "bid" not in [row[1] for row in self.cur.fetchall()]:
+            self.cur.execute("ALTER TABLE content ADD COLUMN bid INTEGER REFERENCES blob")
+        self.conn.commit()
+        self.__loadState()
+
+    ##
+    # \brief read the state of the database kept in meta and sqlite_master
+    def __loadState(self):
+        ## generation of the last commit with writes, see commit()
+        self.generation = int(self.getMeta("generation",0))
+        ## "text" or "zlib", see setContentStorage()
+        self.contentStorage = self.getMeta("content_storage","text")
+        self.cur.execute("SELECT name FROM sqlite_master WHERE name = 'note_fts'")
+        ## whether the full-text index note_fts exists
+        self.hasSearch = self.cur.fetchone() is not None
+        # next fid to give, read by the first __newFids() of a transaction
+        # and written back by commit()
+        self.__nextFid = None
 
     ##
     # expend the current database by given path
     # \param path path to md files
-    def __importDB(self,path):
+    # \param workers number of processes parsing the files, 1 for serial parsing
+    # \param batchSize number of Notes written between two commits
+    def __importDB(self,path,workers=1,batchSize=500):
         path = abspath(path)+'/' # extend to full path
-        files = glob.glob(path+"*.md")
-        for ifile in files:
+        files = [basename(ifile) for ifile in glob.glob(path+"*.md")]
+        self.__ingest(path,files,False,workers,batchSize)
+        logger.summary("Import")
+
+    ##
+    # \brief parse Notes from files, in a process pool if asked
+    # \param path path to md files
+    # \param files list of file names in path
+    # \param workers number of processes parsing the files, 1 for serial parsing
+    # \param stats dict of filename: stat result for the files already stat'ed
+    # \return generator of (filename, Note or None, error message or None)
+    #
+    #  Results are yielded in the order of files whatever the number of workers.
+    #  Serial parsing reads headers only and leaves the content to be read
+    #  when the writer needs it, workers read the whole file.
+    def __loadNotes(self,path,files,workers=1,stats={}):
+        mtimes = [stats[ifile].st_mtime if ifile in stats else None for ifile in files]
+        if workers <= 1 or len(files) < 2:
+            for ifile,mtime in zip(files,mtimes):
+                yield _loadNote((path,ifile,True,mtime))
+            return
+        jobs = [(path,ifile,False,mtime) for ifile,mtime in zip(files,mtimes)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            chunk = max(1,len(jobs)/(workers*8))
+            for result in pool.imap(_loadNote,jobs,chunk):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    ##
+    # \brief write the Notes of given files into database
+    # \param path path to md files
+    # \param files list of file names in path
+    # \param update if set, use updateNote(), otherwise insertNote()
+    # \param workers number of processes parsing the files, 1 for serial parsing
+    # \param batchSize number of Notes written between two commits
+    # \param force set of file names to rewrite even if sys_modified is not newer
+    # \param hashContent if set, store the content hash in manifest
+    # \param stats dict of filename: stat result for the files already stat'ed
+    #
+    #  Parsing runs in the worker processes while the calling thread is the
+    #  single writer of the database.
+    def __ingest(self,path,files,update,workers=1,batchSize=500,
+                 force=frozenset(),hashContent=False,stats={}):
+        count = 0
+        notes = self.__loadNotes(path,files,workers,stats)
+        while True:
+            start = now() if _profile is not None else None
             try:
-                ifile = basename(ifile)
-                print "- Insert "+ifile
-                inote = Note(path,ifile)
-                self.insertNote(inote)
-            except Exception as inst:
-                if (len(inst.args) == 2) and (inst.args[0]=="NoteClass"): # read-in fail
-                    warning(inst.args[1])
-                else: # other problems
-                    raise
-        self.conn.commit()
+                ifile,inote,error = next(notes)
+            except StopIteration:
+                break
+            if inote is None: # read-in fail
+                warning(error)
+                logger.event("fail")
+                continue
+            if start is not None:
+                loaded = now()
+                _profile.add("load",loaded-start)
+            if update:
+                fid = self.updateNote(inote,ifile in force)
+            else:
+                logger.event("insert","- Insert "+ifile)
+                fid = self.insertNote(inote)
+            self.__setManifest(fid,path+ifile,stats.get(ifile),
+                               fileHash(path+ifile) if hashContent else None)
+            if start is not None:
+                _profile.add("write",now()-loaded)
+                _profile.addFile(path,ifile,now()-start)
+            count += 1
+            if count % batchSize == 0:
+                self.commit()
+        self.commit()
 
     ##
     # insert a Note Class
     # \param note a Note Class
+    # \return fid of the new Note
     def insertNote(self,note):
         # insert header
+        gen = self.__writeGen()
+        fid = self.__newFids(1)
         self.cur.execute('''INSERT INTO
-        head (filename,path,author,date_create,date_change,sys_modified)
-        VALUES (?,?,?,?,?,?)''',
-        [note.filename, note.path, note.author,
+        head (fid,filename,path,author,date_create,date_change,sys_modified,gen)
+        VALUES (?,?,?,?,?,?,?,?)''',
+        [fid, note.filename, note.path, note.author,
          strftime("%Y-%m-%d",note.dateCreate),
          strftime("%Y-%m-%d",note.dateChange),
-         strftime("%Y-%m-%d %H:%M:%S",note.modifyTime)
+         strftime("%Y-%m-%d %H:%M:%S",note.modifyTime),
+         gen
         ])
-        self.cur.execute("SELECT last_insert_rowid()")
-        fid = self.cur.fetchone()[0]
         # insert content
-        self.cur.execute("INSERT INTO content VALUES (?,?)",[fid,unicode(note.content)])
-        # insert tag and tf_bridge
-        for itag in note.tags:
-            self.cur.execute("INSERT INTO tag (tag) select (?) where not exists(select tid from tag where tag=?)",[itag,itag])
-            self.cur.execute("select tid from tag where tag =?",[itag]);
-            tid = self.cur.fetchone()[0]
-            self.cur.execute("INSERT INTO tf_bridge (fid,tid) VALUES (?,?)",[fid,tid])
-        # insert ctag and ctf_bridge
-        for itag in note.ctags:
-            itag = unicode(itag)
-            self.cur.execute("INSERT INTO ctag (ctag) select (?) where not exists(select ctid from ctag where ctag=?)",[itag,itag])
-            self.cur.execute("select ctid from ctag where ctag =?",[itag]);
-            tid = self.cur.fetchone()[0]
-            self.cur.execute("INSERT INTO ctf_bridge (fid,ctid) VALUES (?,?)",[fid,tid])
+        self.__writeContent(fid,note.content)
+        if self.hasSearch:
+            self.cur.execute("INSERT INTO note_fts (rowid,content) VALUES (?,?)",[fid,unicode(note.content)])
+        # insert tag/ctag and bridges
+        self.__writeTags(fid,"tag",note.tags)
+        self.__writeTags(fid,"ctag",note.ctags)
+        self.__touchSections(note.tags,note.ctags,strftime("%Y-%m",note.dateChange))
+        return fid
             
     ##
     # update a Note Class
     # \param note Note class
-    def updateNote(self,note):
-        # examine whether note is already in the database
-        self.cur.execute("SELECT fid FROM head WHERE filename == ? AND path == ?",
-                                 [note.filename,note.path])
+    # \param force if set, rewrite the Note even if sys_modified is not newer
+    # \return fid of the Note
+    def updateNote(self,note,force=False):
+        modifyTime = strftime("%Y-%m-%d %H:%M:%S",note.modifyTime)
+        # examine whether note is already in the database and outdated
+        self.cur.execute("SELECT fid, sys_modified < ? FROM head WHERE filename == ? AND path == ?",
+                                 [modifyTime,note.filename,note.path])
         s = self.cur.fetchone()
         if s is None: # new Note
-                warning("- Insert "+note.filename,color=33)
-                self.insertNote(note)
-        else: # Note exist
-            self.cur.execute("SELECT fid from head WHERE fid == ? AND sys_modified < ?"
-                ,[s[0],strftime("%Y-%m-%d %H:%M:%S",note.modifyTime)])
-            s = self.cur.fetchone()
-            # Note need to be updated
-            if s is not None:
-                fid = s[0]                
-                warning("- Updating "+note.filename,color=32)
-                # update head
-                self.cur.execute('''UPDATE head SET filename = ?, path = ?,
-                author = ?, date_create = ?, date_change = ?, sys_modified = ?
-                WHERE fid = ?''',
-                [ note.filename, note.path, note.author,
-                strftime("%Y-%m-%d",note.dateCreate),
-                strftime("%Y-%m-%d",note.dateChange),
-                strftime("%Y-%m-%d %H:%M:%S",note.modifyTime),
-                fid
-                ])
-                # update content
-                self.cur.execute("UPDATE content SET content = ? where fid = ?",[note.content,fid])
-                # update tags
-                pendingtags = note.tags
-                self.cur.execute("SELECT tag, tid FROM tf_bridge JOIN tag USING (tid) WHERE fid = ?",[fid])
-                tagsindb = self.cur.fetchall()
-                for itag in tagsindb:
-                    if itag[0] in pendingtags: # in tag list
-                        pendingtags.remove(itag[0])
-                    else: # remove from database
-                        self.cur.execute("DELETE FROM tf_bridge WHERE fid = ? AND tid = ?",[fid,itag[1]])
-                for itag in pendingtags: # add new tags
-                    self.cur.execute("INSERT INTO tag (tag) SELECT (?) WHERE NOT EXISTS(SELECT tid FROM tag WHERE tag=?)",[itag,itag])
-                    self.cur.execute("SELECT tid FROM tag WHERE tag =?",[itag]);
-                    tid = self.cur.fetchone()[0]
-                    self.cur.execute("INSERT INTO tf_bridge (fid,tid) VALUES (?,?)",[fid,tid])
-                # update ctags
-                pendingtags = note.ctags
-                self.cur.execute("SELECT ctag, ctid FROM ctf_bridge JOIN ctag USING (ctid) WHERE fid = ?",[fid])
-                tagsindb = self.cur.fetchall()
-                for itag in tagsindb:
-                    if itag[0] in pendingtags: # in tag list
-                        pendingtags.remove(itag[0])
-                    else: # remove from database
-                        self.cur.execute("DELETE FROM ctf_bridge WHERE fid = ? AND ctid = ?",[fid,itag[1]])
-                for itag in pendingtags: # add new tags
-                    self.cur.execute("INSERT INTO ctag (ctag) SELECT (?) WHERE NOT EXISTS(SELECT ctid FROM ctag WHERE ctag=?)",[itag,itag])
-                    self.cur.execute("SELECT ctid FROM ctag WHERE ctag =?",[itag]);
-                    tid = self.cur.fetchone()[0]
-                    self.cur.execute("INSERT INTO ctf_bridge (fid,ctid) VALUES (?,?)",[fid,tid])
+                logger.event("insert","- Insert "+note.filename,33)
+                return self.insertNote(note)
+        fid = s[0]
+        # Note need to be updated
+        if force or s[1]:
+            logger.event("update","- Updating "+note.filename,32)
+            self.__touchNote(fid) # sections of the old version
+            # update head
+            self.cur.execute('''UPDATE head SET filename = ?, path = ?,
+            author = ?, date_create = ?, date_change = ?, sys_modified = ?, gen = ?
+            WHERE fid = ?''',
+            [ note.filename, note.path, note.author,
+            strftime("%Y-%m-%d",note.dateCreate),
+            strftime("%Y-%m-%d",note.dateChange),
+            modifyTime,
+            self.__writeGen(),
+            fid
+            ])
+            # update content
+            self.__writeContent(fid,note.content,True)
+            if self.hasSearch:
+                self.cur.execute("UPDATE note_fts SET content = ? WHERE rowid = ?",[unicode(note.content),fid])
+            # update tags and ctags
+            self.__writeTags(fid,"tag",note.tags,True)
+            self.__writeTags(fid,"ctag",note.ctags,True)
+            self.__touchSections(note.tags,note.ctags,strftime("%Y-%m",note.dateChange))
+        return fid
+
+    ##
+    # \brief look up ids of tags, creating the missing ones
+    # \param kind "tag" or "ctag"
+    # \param tags list of tag strings
+    # \return list of tid/ctid
+    #
+    #  The whole tag table is cached in memory at the first call, so only
+    #  new tags cost a statement.
+    def __tagIds(self,kind,tags):
+        table,idcol,bridge = self.TAGTABLES[kind]
+        cache = self.__tagCache.get(kind)
+        if cache is None:
+            self.cur.execute("SELECT %s, %s FROM %s"%(kind,idcol,table))
+            cache = dict((unicode(row[0]),row[1]) for row in self.cur.fetchall())
+            self.__tagCache[kind] = cache
+        ids = []
+        for itag in tags:
+            itag = unicode(itag)
+            tid = cache.get(itag)
+            if tid is None:
+                self.cur.execute("INSERT INTO %s (%s) VALUES (?)"%(table,kind),[itag])
+                tid = cache[itag] = self.cur.lastrowid
+                if kind in self.__tagIndex:
+                    self.__tagIndex[kind].add(itag,tid)
+            ids.append(tid)
+        return ids
+
+    ##
+    # \brief write the bridge rows between a Note and its tags
+    # \param fid fid of the Note
+    # \param kind "tag" or "ctag"
+    # \param tags list of tag strings
+    # \param replace if set, remove the bridges to tags not in the list
+    def __writeTags(self,fid,kind,tags,replace=False):
+        start = now() if _profile is not None else None
+        table,idcol,bridge = self.TAGTABLES[kind]
+        pending = set(self.__tagIds(kind,tags))
+        if replace:
+            self.cur.execute("SELECT %s FROM %s WHERE fid = ?"%(idcol,bridge),[fid])
+            indb = set(row[0] for row in self.cur.fetchall())
+            removed = [(tid,) for tid in indb-pending]
+            self.cur.executemany("DELETE FROM %s WHERE fid = %d AND %s = ?"%(bridge,fid,idcol),removed)
+            self.cur.executemany("UPDATE %s SET refs = refs - 1 WHERE %s = ?"%(table,idcol),removed)
+            pending -= indb
+        added = [(tid,) for tid in pending]
+        self.cur.executemany("INSERT INTO %s (fid,%s) VALUES (%d,?)"%(bridge,idcol,fid),added)
+        self.cur.executemany("UPDATE %s SET refs = refs + 1 WHERE %s = ?"%(table,idcol),added)
+        index = self.__tagIndex.get(kind)
+        if index is not None:
+            for tid in pending:
+                index.addWeight(tid,1)
+            for tid, in (removed if replace else []):
+                index.addWeight(tid,-1)
+        if start is not None:
+            _profile.add("tagsql",now()-start)
+
+    ##
+    # \brief tune SQLite for bulk loading (opt-in)
+    # \param journal journal mode, WAL keeps readers going during the load
+    # \param synchronous NORMAL skips most of the fsync calls in WAL mode
+    # \param cacheSize page cache size in KiB
+    def setBulkMode(self,journal="WAL",synchronous="NORMAL",cacheSize=65536):
+        self.cur.execute("PRAGMA journal_mode = %s"%journal)
+        self.cur.execute("PRAGMA synchronous = %s"%synchronous)
+        self.cur.execute("PRAGMA cache_size = -%d"%cacheSize)
+
+    ##
+    # \brief commit the pending writes
+    #
+    #  A commit with writes starts a new generation: every Note written
+    #  since the previous commit gets head.gen = generation.
+    def commit(self):
+        start = now() if _profile is not None else None
+        if self.__dirty:
+            self.generation += 1
+            self.setMeta("generation",self.generation)
+            if self.__nextFid is not None:
+                self.setMeta("next_fid",self.__nextFid)
+            self.__dirty = False
+        self.conn.commit()
+        self.__nextFid = None # another connection may insert before the next write
+        if start is not None:
+            _profile.add("commit",now()-start)
+
+    ##
+    # \brief discard the pending writes
+    #
+    #  The tag ids, tag index and cached results held in memory may refer
+    #  to rolled back rows, so they are dropped too.
+    def rollback(self):
+        self.conn.rollback()
+        self.__tagCache.clear()
+        self.__tagIndex.clear()
+        self.__dirty = False
+        self.__changes += 1
+        self.cache.clear()
+        self.__loadState()
+
+    ##
+    # \brief note that a write is pending
+    # \return generation the write will belong to once committed
+    def __writeGen(self):
+        self.__dirty = True
+        self.__changes += 1
+        return self.generation+1
+
+    ##
+    # \brief answer a read from the result cache
+    # \param key cache key, method name and arguments
+    # \param compute function computing the result on a miss
+    # \param args arguments of compute
+    #
+    #  Every write since the last read drops the whole cache, also the
+    #  writes committed by other connections.  Lists are copied, so callers
+    #  may modify what they get.
+    def __cached(self,key,compute,*args):
+        self.__validate()
+        value = self.cache.get(key)
+        if value is LRUCache.MISSING:
+            value = compute(*args)
+            if isinstance(value,list):
+                value = tuple(value)
+            self.cache.put(key,value)
+        return list(value) if isinstance(value,tuple) else value
+
+    ##
+    # \brief drop the result cache if the database changed since the last read
+    #
+    #  A read-only instance also reloads its state and drops its tag index.
+    def __validate(self):
+        self.cur.execute("PRAGMA data_version")
+        if self.cache.validate((self.__changes,self.cur.fetchone()[0])) and self.readonly:
+            self.__loadState()
+            self.__tagIndex.clear()
+
+    ##
+    # \brief hit/miss counters of the result cache
+    # \return dict of hits, misses, evictions, items and bytes
+    def cacheStats(self):
+        return self.cache.stats()
+
+    ##
+    # \brief mark IndexPage sections as changed
+    # \param tags list of tags
+    # \param ctags list of ctags
+    # \param month "YYYY-MM" of date_change
+    def __touchSections(self,tags,ctags,month):
+        gen = self.__writeGen()
+        rows = [("tag",unicode(itag),gen) for itag in tags]
+        rows.extend(("ctag",unicode(itag),gen) for itag in ctags)
+        rows.append(("date",unicode(month),gen))
+        self.cur.executemany("INSERT OR REPLACE INTO index_dirty (section,name,gen) VALUES (?,?,?)",rows)
+
+    ##
+    # \brief mark the IndexPage sections of a Note in database as changed
+    # \param fid fid of the Note
+    def __touchNote(self,fid):
+        self.cur.execute("SELECT substr(date_change,1,7) FROM head WHERE fid = ?",[fid])
+        month = self.cur.fetchone()[0]
+        self.cur.execute("SELECT tag FROM tf_bridge JOIN tag USING (tid) WHERE fid = ?",[fid])
+        tags = [row[0] for row in self.cur.fetchall()]
+        self.cur.execute("SELECT ctag FROM ctf_bridge JOIN ctag USING (ctid) WHERE fid = ?",[fid])
+        ctags = [row[0] for row in self.cur.fetchall()]
+        self.__touchSections(tags,ctags,month)
+
+    ##
+    # \brief read a value of the meta table
+    # \param key name of the value
+    # \param default returned if the key is not set
+    def getMeta(self,key,default=None):
+        self.cur.execute("SELECT value FROM meta WHERE key = ?",[key])
+        row = self.cur.fetchone()
+        return default if row is None else row[0]
+
+    ##
+    # \brief write a value of the meta table
+    # \param key name of the value
+    # \param value the value
+    def setMeta(self,key,value):
+        self.cur.execute("INSERT OR REPLACE INTO meta (key,value) VALUES (?,?)",[key,value])
+
+    ##
+    # \brief reserve fids for new Notes
+    # \param count number of fids
+    # \return first fid, the others follow it
+    #
+    #  fids only grow, even the one of the last deleted Note is not given
+    #  again, so a fid in changedSince() always means the same Note.  The
+    #  counter is read once per transaction and written by commit().
+    def __newFids(self,count):
+        if self.__nextFid is None:
+            self.__nextFid = self.getMeta("next_fid")
+            if self.__nextFid is None:
+                self.cur.execute("SELECT max(coalesce((SELECT max(fid) FROM head),0),"
+                                 "coalesce((SELECT max(fid) FROM deleted),0))")
+                self.__nextFid = self.cur.fetchone()[0]+1
+        first = self.__nextFid
+        self.__nextFid += count
+        return first
+
+    ##
+    # \brief list the tags in use with their number of Notes
+    # \param kind "tag" or "ctag"
+    # \return list of (tag, count) sorted by tag
+    def listTags(self,kind="tag"):
+        return self.__cached(("listTags",kind),self.__listTags,kind)
+
+    def __listTags(self,kind):
+        table,idcol,bridge = self.TAGTABLES[kind]
+        self.cur.execute("SELECT %s, refs FROM %s WHERE refs > 0 ORDER BY %s"%(kind,table,kind))
+        return self.cur.fetchall()
+
+    ##
+    # \brief write the content of a Note
+    # \param fid fid of the Note
+    # \param text content of the Note
+    # \param update if set, replace the existing content
+    def __writeContent(self,fid,text,update=False):
+        text = unicode(text)
+        bid = None
+        if update:
+            self.__releaseContent(fid)
+        if self.contentStorage == "zlib":
+            bid = self.__storeBlob(text)
+            text = None
+        if update:
+            self.cur.execute("UPDATE content SET content = ?, bid = ? WHERE fid = ?",[text,bid,fid])
+        else:
+            self.cur.execute("INSERT INTO content (fid,content,bid) VALUES (?,?,?)",[fid,text,bid])
+
+    ##
+    # \brief store a content in blob, or share the existing one
+    # \param text content
+    # \return bid
+    def __storeBlob(self,text):
+        data = text.encode("UTF-8")
+        digest = hashlib.sha1(data).hexdigest()
+        self.cur.execute("SELECT bid FROM blob WHERE hash = ?",[digest])
+        row = self.cur.fetchone()
+        if row is not None:
+            self.cur.execute("UPDATE blob SET refs = refs + 1 WHERE bid = ?",[row[0]])
+            return row[0]
+        self.cur.execute("INSERT INTO blob (hash,data,refs) VALUES (?,?,1)",
+                         [digest,sql.Binary(zlib.compress(data))])
+        return self.cur.lastrowid
+
+    ##
+    # \brief drop the reference of a Note to its blob
+    # \param fid fid of the Note
+    def __releaseContent(self,fid):
+        self.cur.execute("SELECT bid FROM content WHERE fid = ?",[fid])
+        row = self.cur.fetchone()
+        if row is None or row[0] is None:
+            return
+        self.cur.execute("UPDATE blob SET refs = refs - 1 WHERE bid = ?",[row[0]])
+        self.cur.execute("DELETE FROM blob WHERE bid = ? AND refs <= 0",[row[0]])
+
+    ##
+    # \brief iterate over all contents
+    # \return generator of (fid, content text)
+    def __iterContent(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT fid, content, data FROM content LEFT JOIN blob USING (bid)")
+        for fid,text,data in cur:
+            yield (fid,_readContent(text,data))
+
+    ##
+    # \brief get file content by file name
+    # \param filename file name of the Note
+    # \param path path of the Note, any path if None
+    # \return content text, None if there is no such Note
+    def getContent(self,filename,path=None):
+        return self.__cached(("getContent",unicode(filename),path),self.__getContent,filename,path)
+
+    def __getContent(self,filename,path):
+        query = '''SELECT content, data FROM head JOIN content USING (fid)
+        LEFT JOIN blob USING (bid) WHERE filename = ?'''
+        args = [unicode(filename)]
+        if path is not None:
+            query += " AND path = ?"
+            args.append(unicode(abspath(path)+'/'))
+        self.cur.execute(query+" LIMIT 1",args)
+        row = self.cur.fetchone()
+        return None if row is None else _readContent(*row)
+
+    ##
+    # \brief convert the stored contents
+    # \param mode "zlib" to store contents compressed and deduplicated,
+    #   "text" to store them as plain TEXT
+    # \param vacuum if set, rebuild the database file to release free pages
+    #
+    #  New and updated Notes follow the chosen mode, it is kept in meta.
+    def setContentStorage(self,mode,vacuum=True):
+        if mode not in ("text","zlib"):
+            raise Exception("!! Unknown content storage '%s' !!"%mode)
+        self.contentStorage = mode
+        self.setMeta("content_storage",mode)
+        if mode == "zlib":
+            self.cur.execute("SELECT fid FROM content WHERE bid IS NULL")
+        else:
+            self.cur.execute("SELECT fid FROM content WHERE bid IS NOT NULL")
+        fids = [row[0] for row in self.cur.fetchall()]
+        for ii in range(0,len(fids),500):
+            chunk = fids[ii:ii+500]
+            self.cur.execute('''SELECT fid, content, data FROM content LEFT JOIN blob USING (bid)
+            WHERE fid IN (%s)'''%",".join("?"*len(chunk)),chunk)
+            for fid,text,data in self.cur.fetchall():
+                self.__writeContent(fid,_readContent(text,data),True)
+            self.conn.commit()
+        self.conn.commit()
+        if vacuum:
+            self.conn.execute("VACUUM")
+
+    ##
+    # \brief size and read cost of the stored contents
+    # \param sample number of Notes read to time getContent()
+    # \return dict with notes, blobs, text_bytes (content as UTF-8),
+    #   stored_bytes (TEXT plus blob data), ratio (stored_bytes to
+    #   text_bytes), search_bytes (note_fts and its shadow tables, which keep
+    #   another uncompressed copy of the content), total_bytes (stored_bytes
+    #   plus search_bytes) and read_ms per Note
+    def contentReport(self,sample=1000):
+        self.cur.execute('''SELECT count(*), count(DISTINCT bid),
+        coalesce(sum(length(CAST(content AS BLOB))),0) FROM content''')
+        notes,blobs,textBytes = self.cur.fetchone()
+        self.cur.execute("SELECT coalesce(sum(length(data)),0) FROM blob")
+        blobBytes = self.cur.fetchone()[0]
+        rawBytes = 0
+        for fid,text in self.__iterContent():
+            rawBytes += len(text.encode("UTF-8"))
+        self.cur.execute("SELECT filename, path FROM head ORDER BY random() LIMIT ?",[sample])
+        names = self.cur.fetchall()
+        start = now()
+        for filename,path in names:
+            self.getContent(filename,path)
+        readMs = (now()-start)*1000/len(names) if names else 0.0
+        stored = textBytes+blobBytes
+        searchBytes = 0
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                         "AND name LIKE 'note\\_fts\\_%' ESCAPE '\\'")
+        for table, in self.cur.fetchall():
+            self.cur.execute("PRAGMA table_info(%s)"%table)
+            columns = ["coalesce(sum(length(CAST(%s AS BLOB))),0)"%row[1] for row in self.cur.fetchall()]
+            self.cur.execute("SELECT %s FROM %s"%(" + ".join(columns),table))
+            searchBytes += self.cur.fetchone()[0]
+        return {"storage": self.contentStorage, "notes": notes, "blobs": blobs,
+                "text_bytes": rawBytes, "stored_bytes": stored,
+                "ratio": float(stored)/rawBytes if rawBytes else 1.0,
+                "search_bytes": searchBytes, "total_bytes": stored+searchBytes,
+                "read_ms": readMs}
+
+    ##
+    # \brief write all Notes into a JSONL file
+    # \param filename name of the file, gzip compressed if it ends with .gz
+    # \param workers number of processes reading the database
+    # \param chunkSize number of fids read at a time by a process
+    # \return number of Notes written
+    #
+    #  Fid ranges are read in parallel and written in fid order, only
+    #  workers*2 ranges are held in memory.  The pending writes are committed
+    #  first so that the readers see them.
+    def exportJSON(self,filename,workers=1,chunkSize=1000):
+        self.commit()
+        self.cur.execute("PRAGMA database_list")
+        dbfile = self.cur.fetchone()[2]
+        self.cur.execute("SELECT min(fid), max(fid) FROM head")
+        first,last = self.cur.fetchone()
+        count = 0
+        compress = filename.endswith(".gz")
+        with open(filename,"wb") as f:
+            if first is None:
+                return count
+            jobs = ((dbfile,lo,lo+chunkSize,compress) for lo in xrange(first,last+1,chunkSize))
+            for n,text in _orderedMap(_exportRange,jobs,workers):
+                f.write(text)
+                count += n
+        return count
+
+    ##
+    # \brief read Notes from a JSONL file written by exportJSON()
+    # \param filename name of the file, gzip compressed if it ends with .gz
+    # \param workers number of processes decoding the JSON
+    # \param batchSize number of Notes written between two commits
+    # \return number of Notes read
+    #
+    #  New Notes are written with bulk inserts.  A Note already in the
+    #  database goes through updateNote(), so the newer version is kept.
+    #  The manifest of the file is restored as well: an updateTree() after
+    #  the import only reads the files changed since the export.
+    def importJSON(self,filename,workers=1,batchSize=500):
+        count = 0
+        with _openJSON(filename) as f:
+            for records in _orderedMap(_parseJSON,_readChunks(f,batchSize),workers):
+                self.__insertJSON(records)
+                self.commit()
+                count += len(records)
+        return count
+
+    ##
+    # \brief write a batch of JSON objects of Notes
+    # \param records list of dict, see exportJSON()
+    def __insertJSON(self,records):
+        start = now() if _profile is not None else None
+        byPath = {}
+        for obj in records:
+            byPath.setdefault(obj["path"],[]).append(obj["filename"])
+        indb = set()
+        for path,names in byPath.items():
+            indb.update((path,unicode(name)) for name in self.__loadManifest(path,names))
+        new = []
+        for obj in records:
+            if (obj["path"],obj["filename"]) in indb:
+                self.updateNote(Note.fromJSON(obj))
+            else:
+                new.append(obj)
+        first = self.__newFids(len(new))
+        fids = range(first,first+len(new))
+        gen = self.__writeGen()
+        self.cur.executemany('''INSERT INTO
+        head (fid,filename,path,author,date_create,date_change,sys_modified,gen)
+        VALUES (?,?,?,?,?,?,?,?)''',
+        [(fid,obj["filename"],obj["path"],obj["Author"],obj["Date_create"],
+          obj["Date_change"],obj["Date_modified"],gen) for fid,obj in zip(fids,new)])
+        if self.contentStorage == "text":
+            self.cur.executemany("INSERT INTO content (fid,content) VALUES (?,?)",
+                                 [(fid,obj["content"]) for fid,obj in zip(fids,new)])
+        else:
+            for fid,obj in zip(fids,new):
+                self.__writeContent(fid,obj["content"])
+        if self.hasSearch:
+            self.cur.executemany("INSERT INTO note_fts (rowid,content) VALUES (?,?)",
+                                 [(fid,obj["content"]) for fid,obj in zip(fids,new)])
+        self.cur.executemany("INSERT INTO manifest (fid,size,mtime,hash) VALUES (?,?,?,?)",
+                             [(fid,obj["manifest"]["size"],obj["manifest"]["mtime"],obj["manifest"]["hash"])
+                              for fid,obj in zip(fids,new) if obj.get("manifest")])
+        # !!! bridges, refs and sections of the whole batch at once !!! #
+        sections = {}
+        for kind,(table,idcol,bridge) in self.TAGTABLES.items():
+            rows = []
+            refs = {}
+            for fid,obj in zip(fids,new):
+                for tid in set(self.__tagIds(kind,obj[kind+"s"])):
+                    rows.append((fid,tid))
+                    refs[tid] = refs.get(tid,0)+1
+                for itag in obj[kind+"s"]:
+                    sections[(kind,unicode(itag))] = gen
+            self.cur.executemany("INSERT INTO %s (fid,%s) VALUES (?,?)"%(bridge,idcol),rows)
+            self.cur.executemany("UPDATE %s SET refs = refs + ? WHERE %s = ?"%(table,idcol),
+                                 [(n,tid) for tid,n in refs.items()])
+            if kind in self.__tagIndex:
+                for tid,n in refs.items():
+                    self.__tagIndex[kind].addWeight(tid,n)
+        for obj in new:
+            sections[("date",unicode(obj["Date_change"][:7]))] = gen
+        self.cur.executemany("INSERT OR REPLACE INTO index_dirty (section,name,gen) VALUES (?,?,?)",
+                             [key+(gen,) for key in sections])
+        if start is not None:
+            _profile.add("write",now()-start,len(records))
+
+    ##
+    # \brief remove a Note from database
+    # \param fid fid of the Note
+    def deleteNote(self,fid):
+        self.__touchNote(fid)
+        self.cur.execute("INSERT INTO deleted (fid,filename,path,gen) SELECT fid, filename, path, ? FROM head WHERE fid = ?",
+                         [self.__writeGen(),fid])
+        self.__writeTags(fid,"tag",[],True)
+        self.__writeTags(fid,"ctag",[],True)
+        self.__releaseContent(fid)
+        self.cur.execute("DELETE FROM content WHERE fid = ?",[fid])
+        if self.hasSearch:
+            self.cur.execute("DELETE FROM note_fts WHERE rowid = ?",[fid])
+        self.cur.execute("DELETE FROM manifest WHERE fid = ?",[fid])
+        self.cur.execute("DELETE FROM head WHERE fid = ?",[fid])
+
+    ##
+    # \brief record the file state of a Note in manifest
+    # \param fid fid of the Note
+    # \param filename full name of the Note file
+    # \param st stat result of the file, taken from filename if not given
+    # \param digest content hash of the file, if known
+    def __setManifest(self,fid,filename,st=None,digest=None):
+        if st is None:
+            st = os.stat(filename)
+        self.cur.execute("INSERT OR REPLACE INTO manifest (fid,size,mtime,hash) VALUES (?,?,?,?)",
+                         [fid,st.st_size,st.st_mtime,digest])
+
+    ##
+    # \brief read manifest of the Notes in a directory
+    # \param path path to the notes files
+    # \param names list of file names to read, all Notes of path if None
+    # \return dict of filename: (fid, size, mtime, hash), size is None if the Note has no manifest
+    def __loadManifest(self,path,names=None):
+        query = "SELECT filename, fid, size, mtime, hash FROM head LEFT JOIN manifest USING (fid) WHERE path = ?"
+        args = [unicode(path)]
+        if names is not None:
+            query += " AND filename IN (%s)"%",".join("?"*len(names))
+            args.extend(unicode(name) for name in names)
+        self.cur.execute(query,args)
+        return dict((unicode(row[0]),row[1:]) for row in self.cur.fetchall())
                     
     ##
     # update the database for given directory
     # \param path path to the notes files
-    def updateDB(self,path):
+    # \param workers number of processes parsing the files, 1 for serial parsing
+    # \param batchSize number of Notes written between two commits
+    # \param hashContent if set, compare content hash when size or mtime changed
+    #
+    #  Files whose size and mtime match the manifest are skipped with only a stat.
+    #  Notes whose file disappeared are removed, unless a new file with the same
+    #  size and mtime (and hash if known) shows up, then the Note is renamed.
+    def updateDB(self,path,workers=1,batchSize=500,hashContent=False):
+        self.updateTree([path],recursive=False,workers=workers,
+                        batchSize=batchSize,hashContent=hashContent)
+
+    ##
+    # \brief update the database for directory trees
+    # \param roots list of directories
+    # \param include fnmatch patterns of the note files
+    # \param exclude fnmatch patterns of file and directory names to skip
+    # \param recursive if set, also scan sub-directories
+    # \param workers number of processes parsing the files, 1 for serial parsing
+    # \param batchSize number of Notes written between two commits
+    # \param hashContent if set, compare content hash when size or mtime changed
+    #
+    #  Directories are synced one at a time as scanTree() lists them, like
+    #  updateDB().  Notes in directories of the roots which are gone (or
+    #  excluded now) are removed.  A directory which cannot be listed (e.g.
+    #  an unmounted root) is left alone, with everything below it.
+    def updateTree(self,roots,include=("*.md",),exclude=(".*",),recursive=True,
+                   workers=1,batchSize=500,hashContent=False):
+        seen = set()
+        failed = []
+        scan = scanTree(roots,include,exclude,recursive,failed)
+        while True:
+            start = now() if _profile is not None else None
+            try:
+                path,entries = next(scan)
+            except StopIteration:
+                break
+            if start is not None:
+                _profile.add("scan",now()-start,len(entries))
+            path = unicode(path)
+            seen.add(path)
+            entries = dict((unicode(name),st) for name,st in entries.items())
+            self.__syncDir(path,entries,True,workers,batchSize,hashContent)
+        # !!! directories which disappeared from a listed parent !!! #
+        failed = tuple(unicode(path) for path in failed)
+        for root in roots:
+            root = unicode(abspath(root))+'/'
+            if root.startswith(failed):
+                continue
+            if recursive:
+                self.cur.execute("SELECT DISTINCT path FROM head WHERE path >= ? AND path < ?",
+                                 [root,root+u"\uffff"])
+                paths = [unicode(row[0]) for row in self.cur.fetchall()]
+            else:
+                paths = [root]
+            for path in paths:
+                if path not in seen and not path.startswith(failed):
+                    self.__syncDir(path,{},True,workers,batchSize,hashContent)
+        logger.summary("Sync")
+
+    ##
+    # \brief update the database for some files of a directory
+    # \param path path to the notes files
+    # \param names list of file names, changed, created or removed
+    # \param hashContent if set, compare content hash when size or mtime changed
+    #
+    #  Same as updateDB() restricted to the given files, a name whose file
+    #  does not exist anymore removes (or renames) its Note.
+    def syncFiles(self,path,names,hashContent=False):
         path = abspath(path)+'/' # extend to full path
-        files = glob.glob(path+"*.md")
-        for ifile in files:
+        entries = {}
+        for ifile in names:
             try:
-                ifile = basename(ifile)
-                inote = Note(path,ifile)
-                self.updateNote(inote)
-            except Exception as inst:
-                if (len(inst.args) == 2) and (inst.args[0]=="NoteClass"): # read-in fail
-                    warning(inst.args[1])
-                else: # other problems
-                    raise
-        self.conn.commit()
+                entries[unicode(ifile)] = os.stat(path+ifile)
+            except OSError: # removed
+                entries[unicode(ifile)] = None
+        self.__syncDir(path,entries,False,1,500,hashContent)
+        logger.summary("Sync")
+
+    ##
+    # \brief bring the Notes of a directory in line with its files
+    # \param path path to the notes files
+    # \param entries dict of filename: stat result, None for removed files
+    # \param complete if set, entries lists the whole directory, so any other
+    #   Note of path is removed
+    # \param workers number of processes parsing the files, 1 for serial parsing
+    # \param batchSize number of Notes written between two commits
+    # \param hashContent if set, compare content hash when size or mtime changed
+    def __syncDir(self,path,entries,complete,workers,batchSize,hashContent):
+        start = now() if _profile is not None else None
+        known = self.__loadManifest(path,None if complete else entries.keys())
+        files = []
+        force = set()
+        newfiles = {}
+        for ifile,st in entries.items():
+            if st is None: # removed, left in known
+                continue
+            rec = known.pop(ifile,None)
+            if rec is None: # new file or renamed
+                newfiles[ifile] = st
+                continue
+            fid,size,mtime,digest = rec
+            if size is None: # no manifest yet, rely on sys_modified
+                files.append(ifile)
+                continue
+            if size == st.st_size and mtime == st.st_mtime:
+                continue
+            if hashContent and digest is not None and size == st.st_size \
+               and digest == fileHash(path+ifile): # touched only
+                self.__setManifest(fid,path+ifile,st,digest)
+                continue
+            files.append(ifile)
+            force.add(ifile)
+        # !!! match vanished Notes with new files !!! #
+        vanished = dict(((rec[1],rec[2]),(name,rec)) for name,rec in known.items()
+                        if rec[1] is not None)
+        for ifile,st in sorted(newfiles.items()):
+            match = vanished.get((st.st_size,st.st_mtime))
+            if match is not None and (match[1][3] is None or
+                                      match[1][3] == fileHash(path+ifile)):
+                oldname,rec = match
+                del vanished[(st.st_size,st.st_mtime)]
+                del known[oldname]
+                logger.event("rename","- Rename %s -> %s"%(oldname,ifile),32)
+                self.cur.execute("UPDATE head SET filename = ?, gen = ? WHERE fid = ?",
+                                 [ifile,self.__writeGen(),rec[0]])
+                self.__touchNote(rec[0])
+                self.__setManifest(rec[0],path+ifile,st,rec[3])
+            else:
+                files.append(ifile)
+        for ifile,rec in known.items():
+            logger.event("delete","- Delete "+ifile,33)
+            self.deleteNote(rec[0])
+        files.sort()
+        if start is not None:
+            _profile.add("manifest",now()-start,len(entries))
+        self.__ingest(path,files,True,workers,batchSize,force,hashContent,entries)
 
     ##
     # \brief clean up to make the database tight
     #
-    #  clean the tag/tags which are not available in bridge table anymore.
+    #  clean the tag/ctag which are not available in bridge table anymore.
+    #  They are found by their refs counters, through an index, so this is
+    #  cheap when there is nothing to clean, and tags left over by a run
+    #  which did not clean up are found by the next one.  Call commit() to
+    #  keep the result.
     def cleanTag(self):
-        self.cur.execute("DELETE FROM tag WHERE tid IN ( SELECT tid from tag LEFT OUTER JOIN tf_bridge USING (tid) WHERE fid IS NULL)")
+        for kind,(table,idcol,bridge) in self.TAGTABLES.items():
+            self.cur.execute("SELECT %s, %s FROM %s WHERE refs <= 0"%(idcol,kind,table))
+            rows = self.cur.fetchall()
+            if not rows:
+                continue
+            self.__writeGen()
+            cache = self.__tagCache.get(kind)
+            index = self.__tagIndex.get(kind)
+            for row in rows:
+                if cache is not None:
+                    cache.pop(unicode(row[1]),None)
+                if index is not None:
+                    index.remove(row[0])
+            self.cur.execute("DELETE FROM %s WHERE refs <= 0"%table)
+
+    ##
+    # \brief check the refs counters of tag/ctag against the bridge tables
+    # \param repair if set, fix the counters and remove the unused tags
+    # \return list of (kind, tag, refs, actual number of Notes) which differ
+    def verifyTags(self,repair=False):
+        wrong = []
+        for kind,(table,idcol,bridge) in sorted(self.TAGTABLES.items()):
+            self.cur.execute('''SELECT %s, %s, refs, count(fid) FROM %s LEFT JOIN %s USING (%s)
+            GROUP BY %s HAVING refs IS NOT count(fid)'''%(idcol,kind,table,bridge,idcol,idcol))
+            rows = self.cur.fetchall()
+            wrong.extend((kind,row[1],row[2],row[3]) for row in rows)
+            if repair:
+                self.cur.executemany("UPDATE %s SET refs = ? WHERE %s = ?"%(table,idcol),
+                                     [(row[3],row[0]) for row in rows])
+        if repair:
+            self.__tagIndex.clear()
+            self.cleanTag()
+            self.commit()
+        return wrong
+
+    ##
+    # \brief suggest tags for a partly typed one
+    # \param prefix beginning of the tag, case is ignored
+    # \param kind "tag" or "ctag", None for both
+    # \param limit maximum number of tags
+    # \param fuzzy if set and the prefix gives less than limit tags, add
+    #   the tags containing prefix anywhere
+    # \return list of (tag, number of Notes), most used first
+    #
+    #  The tags are held in a PrefixIndex per kind, built from the tag
+    #  tables on the first call and kept up to date by the writes.
+    def suggestTags(self,prefix,kind=None,limit=10,fuzzy=True):
+        self.__validate()
+        prefix = unicode(prefix).strip()
+        indexes = [self.__prefixIndex(ikind) for ikind in ([kind] if kind else sorted(self.TAGTABLES))]
+        found = []
+        for index in indexes:
+            found.extend(index.complete(prefix,limit))
+        if fuzzy and len(found) < limit and prefix:
+            known = set(found)
+            for index in indexes:
+                found.extend(x for x in index.search(prefix,limit) if x not in known)
+        return sorted(found,key=lambda x: -x[1])[:limit]
+
+    ##
+    # \brief PrefixIndex of a tag table
+    # \param kind "tag" or "ctag"
+    def __prefixIndex(self,kind):
+        index = self.__tagIndex.get(kind)
+        if index is None:
+            table,idcol,bridge = self.TAGTABLES[kind]
+            self.cur.execute("SELECT %s, %s, refs FROM %s"%(kind,idcol,table))
+            index = self.__tagIndex[kind] = PrefixIndex(
+                (unicode(row[0]),row[1],row[2]) for row in self.cur.fetchall())
+        return index
         
+    ##
+    # \brief create the full-text index of the content
+    # \param tokenizer FTS5 tokenizer, "trigram" matches any substring of
+    #   3 characters or more, which works for Chinese text without word
+    #   boundaries; "unicode61" matches whole words separated by spaces
+    #
+    #  Once created, the index is kept in sync by insertNote(), updateNote()
+    #  and deleteNote().  Calling it again rebuilds the index.
+    def enableSearch(self,tokenizer="trigram"):
+        try:
+            self.cur.execute("DROP TABLE IF EXISTS note_fts")
+            self.cur.execute("CREATE VIRTUAL TABLE note_fts USING fts5(content, tokenize = '%s')"%tokenizer)
+        except sql.OperationalError as inst:
+            raise Exception("!! FTS5 is not available: %s !!"%inst.args[0])
+        self.cur.executemany("INSERT INTO note_fts (rowid,content) VALUES (?,?)",self.__iterContent())
+        self.conn.commit()
+        self.hasSearch = True
+
+    ##
+    # \brief full-text search of the content
+    # \param query FTS5 query string
+    # \param tags list of tags the Notes must all have
+    # \param ctags list of ctags the Notes must all have
+    # \param since earliest date_change, "YYYY-MM-DD" string
+    # \param until latest date_change, "YYYY-MM-DD" string
+    # \param limit maximum number of hits
+    # \return list of (filename, path, bm25 rank, snippet), best hit first
+    #
+    #  The trigram tokenizer only matches words of 3 characters or more.
+    #  Shorter words of a plain query, like the Chinese 数据 or 笔记, are
+    #  matched as substrings with LIKE instead, which reads the content
+    #  of every Note left by the other words.  A query of short words only
+    #  has no bm25 rank (0.0): its hits come newest first.  FTS5 syntax
+    #  (quotes, AND, OR, NOT, NEAR, "*") disables this, the query then goes
+    #  to MATCH as it is.
+    def search(self,query,tags=[],ctags=[],since=None,until=None,limit=20):
+        return self.__cached(("search",unicode(query),tuple(tags),tuple(ctags),since,until,limit),
+                             self.__search,query,tags,ctags,since,until,limit)
+
+    def __search(self,query,tags,ctags,since,until,limit):
+        if not self.hasSearch:
+            raise Exception("!! Full-text search is not enabled, call enableSearch() !!")
+        match,short = _splitQuery(query)
+        cond = []
+        args = []
+        if match is not None:
+            cond.append("note_fts MATCH ?")
+            args.append(match)
+        for word in short:
+            cond.append("note_fts.content LIKE ? ESCAPE '\\'")
+            args.append(u"%%%s%%"%re.sub(r"([\\%_])",r"\\\1",word))
+        if not cond:
+            return []
+        for kind,taglist in (("tag",tags),("ctag",ctags)):
+            table,idcol,bridge = self.TAGTABLES[kind]
+            for itag in taglist:
+                cond.append("head.fid IN (SELECT fid FROM %s JOIN %s USING (%s) WHERE %s = ?)"
+                            %(bridge,table,idcol,kind))
+                args.append(unicode(itag.strip().capitalize()))
+        if since is not None:
+            cond.append("head.date_change >= ?")
+            args.append(since)
+        if until is not None:
+            cond.append("head.date_change <= ?")
+            args.append(until)
+        args.append(limit)
+        if match is not None:
+            self.cur.execute('''SELECT filename, path, bm25(note_fts),
+            snippet(note_fts, 0, '[', ']', '...', 16)
+            FROM note_fts JOIN head ON head.fid = note_fts.rowid
+            WHERE %s ORDER BY bm25(note_fts) LIMIT ?'''%" AND ".join(cond),args)
+            return self.cur.fetchall()
+        # no rank nor snippet() without MATCH: newest first, text around the word
+        self.cur.execute('''SELECT filename, path, note_fts.content
+        FROM note_fts JOIN head ON head.fid = note_fts.rowid
+        WHERE %s ORDER BY head.date_change DESC LIMIT ?'''%" AND ".join(cond),args)
+        hits = []
+        for filename,path,content in self.cur.fetchall():
+            word = short[0]
+            ii = content.lower().find(word.lower())
+            jj = ii+len(word)
+            snippet = "%s%s[%s]%s%s"%("..." if ii > 24 else "",content[max(ii-24,0):ii],content[ii:jj],
+                                      content[jj:jj+24],"..." if jj+24 < len(content) else "")
+            hits.append((filename,path,0.0,snippet.replace("\n"," ")))
+        return hits
+
+    ##
+    # \brief get file names by a boolean tag expression
+    # \param expr tag expression, see below
+    # \param prefix if set, every tag in expr matches as a prefix
+    # \return list of (filename, path)
+    #
+    #  The expression combines tags with AND, OR, NOT and parentheses,
+    #  AND binds tighter than OR and may be omitted between two tags.
+    #  A plain tag matches both tags and ctags, "tag:" or "ctag:" restricts
+    #  it to one of them, and a trailing "*" matches it as a prefix.
+    #  A tag with spaces, or named AND, OR or NOT, is written in double
+    #  quotes: "Script document", tag:"Not", "Script doc"*.
+    #  Tags are normalized like in Note, so case is ignored.
+    #
+    #  > Python AND (tag:Sql OR 数据库) NOT Draft* <br>
+    #  > tag:"Script document" OR "To do" <br>
+    def getFileByTag(self,expr,prefix=False):
+        return self.__cached(("getFileByTag",unicode(expr),prefix),self.__getFileByTag,expr,prefix)
+
+    def __getFileByTag(self,expr,prefix):
+        cond,args,driver,dargs = self.__tagCondition(expr,prefix)
+        if driver is None: # only negations, scan all Notes
+            self.cur.execute("SELECT filename, path FROM head WHERE %s ORDER BY path, filename"%cond,args)
+        else:
+            self.cur.execute("SELECT filename, path FROM head WHERE fid IN (%s) AND %s ORDER BY path, filename"
+                             %(driver,cond),dargs+args)
+        return self.cur.fetchall()
+
+    ##
+    # \brief compile a tag expression
+    # \param expr tag expression, see getFileByTag()
+    # \param prefix if set, every tag in expr matches as a prefix
+    # \return tuple of (condition on head.fid, its parameters,
+    #   select of candidate fid or None, its parameters)
+    def __tagCondition(self,expr,prefix=False):
+        tokens = _TAGTOKEN.findall(unicode(expr))
+        tree = self.__parseTagOr(tokens,prefix)
+        if tokens:
+            raise Exception("!! Unexpected '%s' in tag expression !!"%tokens[0])
+        return self.__compileTag(tree)[:4]
+
+    ##
+    # \brief get file names by a date range, optionally with a tag expression
+    # \param since earliest date, included
+    # \param until latest date, included
+    # \param field "date_change", "date_create" ("YYYY-MM-DD") or
+    #   "sys_modified" ("YYYY-MM-DD HH:MM:SS")
+    # \param tags tag expression as in getFileByTag(), None for all Notes
+    # \return list of (filename, path, date) sorted by date
+    #
+    #  An "until" date matches the whole day for sys_modified.
+    def getFileByDate(self,since=None,until=None,field="date_change",tags=None):
+        return self.__cached(("getFileByDate",since,until,field,tags),
+                             self.__getFileByDate,since,until,field,tags)
+
+    def __getFileByDate(self,since,until,field,tags):
+        if field not in ("date_create","date_change","sys_modified"):
+            raise Exception("!! Unknown date field '%s' !!"%field)
+        cond = []
+        args = []
+        if since is not None:
+            cond.append("%s >= ?"%field)
+            args.append(since)
+        if until is not None:
+            if field == "sys_modified" and len(until) == 10: # whole day
+                until += " 23:59:59"
+            cond.append("%s <= ?"%field)
+            args.append(until)
+        if tags is not None:
+            tagcond,tagargs = self.__tagCondition(tags)[:2]
+            cond.append(tagcond)
+            args.extend(tagargs)
+        self.cur.execute("SELECT filename, path, %s FROM head%s ORDER BY %s, path, filename"
+                         %(field," WHERE "+" AND ".join(cond) if cond else "",field),args)
+        return self.cur.fetchall()
+
+    ##
+    # \brief Notes changed and removed after a generation
+    # \param generation generation already seen by the caller, 0 for all
+    # \return tuple of (current generation, list of (fid, filename, path, gen)
+    #   of changed Notes, list of (fid, filename, path, gen) of removed Notes)
+    #
+    #  Pass the returned generation to the next call to get only the deltas.
+    #  Uncommitted writes are left for the next call.
+    def changedSince(self,generation=0):
+        if self.readonly:
+            self.__loadState()
+        gen = self.generation
+        self.cur.execute("SELECT fid, filename, path, gen FROM head WHERE gen > ? AND gen <= ? ORDER BY gen, fid",
+                         [generation,gen])
+        changed = self.cur.fetchall()
+        self.cur.execute("SELECT fid, filename, path, gen FROM deleted WHERE gen > ? AND gen <= ? ORDER BY gen, fid",
+                         [generation,gen])
+        return (gen,changed,self.cur.fetchall())
+
+    ##
+    # \brief parse an OR list of a tag expression
+    # \param tokens list of tokens, consumed from the front
+    # \param prefix if set, every tag matches as a prefix
+    # \return expression tree
+    def __parseTagOr(self,tokens,prefix):
+        terms = [self.__parseTagAnd(tokens,prefix)]
+        while tokens and tokens[0] == "OR":
+            tokens.pop(0)
+            terms.append(self.__parseTagAnd(tokens,prefix))
+        return ("OR",terms) if len(terms) > 1 else terms[0]
+
+    ##
+    # \brief parse an AND list of a tag expression
+    def __parseTagAnd(self,tokens,prefix):
+        factors = [self.__parseTagNot(tokens,prefix)]
+        while tokens and tokens[0] not in ("OR",")"):
+            if tokens[0] == "AND":
+                tokens.pop(0)
+            factors.append(self.__parseTagNot(tokens,prefix))
+        return ("AND",factors) if len(factors) > 1 else factors[0]
+
+    ##
+    # \brief parse a single tag, a NOT or a parenthesis
+    def __parseTagNot(self,tokens,prefix):
+        if not tokens:
+            raise Exception("!! Incomplete tag expression !!")
+        token = tokens.pop(0)
+        if token == "NOT":
+            return ("NOT",self.__parseTagNot(tokens,prefix))
+        if token == "(":
+            tree = self.__parseTagOr(tokens,prefix)
+            if not tokens or tokens.pop(0) != ")":
+                raise Exception("!! Missing ')' in tag expression !!")
+            return tree
+        if token in ("AND","OR",")"):
+            raise Exception("!! Unexpected '%s' in tag expression !!"%token)
+        kinds = ("tag","ctag")
+        for kind in kinds:
+            if token.startswith(kind+":"):
+                kinds = (kind,)
+                token = token[len(kind)+1:]
+        isprefix = prefix or token.endswith("*")
+        token = token.rstrip("*")
+        if len(token) > 1 and token[0] == token[-1] == '"':
+            token = token[1:-1]
+        elif '"' in token:
+            raise Exception("!! Unterminated quote in tag expression !!")
+        return ("TAG",kinds,token.strip().capitalize(),isprefix)
+
+    ##
+    # \brief compile a tag expression tree into SQL
+    # \param tree expression tree
+    # \return tuple of (condition on head.fid, its parameters,
+    #   select of candidate fid or None, its parameters, estimated number of candidates)
+    #
+    #  The candidates come from the smallest tag of an AND list through the
+    #  bridge indexes, the condition then probes the bridge primary keys for
+    #  each candidate, so the cost follows the rarest tag rather than the
+    #  number of Notes.
+    def __compileTag(self,tree):
+        if tree[0] == "TAG":
+            kinds,token,isprefix = tree[1:]
+            conds = []
+            drivers = []
+            sizes = []
+            args = []
+            for kind in kinds:
+                table,idcol,bridge = self.TAGTABLES[kind]
+                if isprefix: # range scan on the UNIQUE index of the tag table
+                    tagcond = "%s >= ? AND %s < ?"%(kind,kind)
+                    tagargs = [token,token+u"\uffff"]
+                else:
+                    tagcond = "%s = ?"%kind
+                    tagargs = [token]
+                tagsel = "SELECT %s FROM %s WHERE %s"%(idcol,table,tagcond)
+                conds.append("EXISTS (SELECT 1 FROM %s WHERE fid = head.fid AND %s IN (%s))"
+                             %(bridge,idcol,tagsel))
+                drivers.append("SELECT fid FROM %s WHERE %s IN (%s)"%(bridge,idcol,tagsel))
+                sizes.append("(SELECT coalesce(sum(refs),0) FROM %s WHERE %s)"%(table,tagcond))
+                args.extend(tagargs)
+            driver = " UNION ".join(drivers)
+            # number of Notes from the refs counters, to pick the rarest tag
+            self.cur.execute("SELECT "+" + ".join(sizes),args)
+            return ("(%s)"%" OR ".join(conds),args,driver,args,self.cur.fetchone()[0])
+        if tree[0] == "NOT":
+            cond,args = self.__compileTag(tree[1])[:2]
+            return ("NOT "+cond,args,None,[],None)
+        parts = [self.__compileTag(node) for node in tree[1]]
+        args = []
+        for part in parts:
+            args.extend(part[1])
+        if tree[0] == "AND":
+            cond = "(%s)"%" AND ".join(part[0] for part in parts)
+            drivers = [part for part in parts if part[2] is not None]
+            if not drivers:
+                return (cond,args,None,[],None)
+            best = min(drivers,key=lambda part: part[4])
+            return (cond,args,best[2],best[3],best[4])
+        cond = "(%s)"%" OR ".join(part[0] for part in parts)
+        if any(part[2] is None for part in parts):
+            return (cond,args,None,[],None)
+        dargs = []
+        for part in parts:
+            dargs.extend(part[3])
+        return (cond,args," UNION ".join("SELECT fid FROM (%s)"%part[2] for part in parts),
+                dargs,sum(part[4] for part in parts))
+
     ##
     # fetch the content from DB
     # return a list of informations for testing          
@@ -515,16 +2317,211 @@ class NoteDB():
         self.cur.execute("SELECT filename, ctag FROM head JOIN ctf_bridge USING (fid) JOIN ctag USING (ctid)")
         return self.cur.fetchall()
           
+##
+# \class NoteWatcher
+# \brief keep a NoteDB in sync with directories of notes
+#
+#  Linux inotify events (through ctypes) are collected per directory, and
+#  once no event came for debounce seconds the touched files go through
+#  NoteDB.syncFiles().  Without inotify, the directories are rescanned with
+#  NoteDB.updateDB() every interval seconds, which only costs a stat per
+#  unchanged file.  When the inotify queue overflows the lost events are
+#  unknown, so the directories are rescanned the same way.
+class NoteWatcher:
+    ## inotify mask: IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    MASK = 0x8 | 0x40 | 0x80 | 0x200
+    ## inotify event header: wd, mask, cookie, len
+    EVENT = struct.Struct("iIII")
+    ## inotify mask of a lost queue: IN_Q_OVERFLOW
+    OVERFLOW = 0x4000
+
+    ##
+    # \brief Initialization code
+    # \param db a NoteDB
+    # \param paths list of directories of md files
+    # \param debounce seconds without event before the files are synced
+    # \param interval seconds between two scans when polling
+    def __init__(self,db,paths,debounce=1.0,interval=5.0):
+        ## NoteDB to keep in sync
+        self.db = db
+        ## watched directories
+        self.paths = [abspath(path)+'/' for path in paths]
+        ## seconds without event before the files are synced
+        self.debounce = debounce
+        ## seconds between two scans when polling
+        self.interval = interval
+        # self-pipe to wake up run() from stop()
+        self.__wake = os.pipe()
+        self.__running = False
+
+    ##
+    # \brief watch until stop() is called
+    def run(self):
+        self.__running = True
+        for path in self.paths: # catch up with changes made while not watching
+            self.db.updateDB(path)
+        self.__clean()
+        fd = self.__initInotify()
+        try:
+            if fd is None:
+                warning("- inotify unavailable, polling every %gs"%self.interval,color=33)
+                self.__poll()
+            else:
+                self.__watch(fd)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    ##
+    # \brief make run() return, can be called from another thread or a signal handler
+    def stop(self):
+        self.__running = False
+        os.write(self.__wake[1],"x")
+
+    ##
+    # \brief open an inotify instance watching all paths
+    # \return file descriptor, None if inotify is not available
+    def __initInotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+            init = libc.inotify_init
+            addWatch = libc.inotify_add_watch
+        except (OSError,AttributeError):
+            return None
+        fd = init()
+        if fd < 0:
+            return None
+        ## watch descriptor: path
+        self.__wds = {}
+        for path in self.paths:
+            wd = addWatch(fd,path.encode("UTF-8"),self.MASK)
+            if wd < 0:
+                os.close(fd)
+                return None
+            self.__wds[wd] = path
+        return fd
+
+    ##
+    # \brief inotify loop
+    # \param fd inotify file descriptor
+    def __watch(self,fd):
+        pending = {}
+        last = 0
+        while self.__running:
+            timeout = None if not pending else max(0,last+self.debounce-now())
+            ready = self.__select([fd,self.__wake[0]],timeout)
+            if self.__wake[0] in ready:
+                os.read(self.__wake[0],512)
+            if fd in ready:
+                for path,name in self.__readEvents(fd):
+                    if name is None: # events lost, rescan the directory
+                        pending[path] = None
+                    elif pending.get(path,()) is not None:
+                        pending.setdefault(path,set()).add(name)
+                last = now()
+            elif pending and now() >= last+self.debounce:
+                self.__flush(pending)
+                pending = {}
+        if pending:
+            self.__flush(pending)
+
+    ##
+    # \brief select() which returns no ready file when a signal interrupts it
+    # \param rlist file descriptors to read
+    # \param timeout seconds, None to wait
+    # \return list of the ready file descriptors
+    def __select(self,rlist,timeout):
+        try:
+            return select.select(rlist,[],[],timeout)[0]
+        except select.error as inst:
+            if inst.args[0] != errno.EINTR:
+                raise
+            return []
+
+    ##
+    # \brief read the pending inotify events
+    # \param fd inotify file descriptor
+    # \return list of (path, filename) of md files, (path, None) for every
+    #   path when the kernel queue overflowed and events were lost
+    def __readEvents(self,fd):
+        buf = os.read(fd,65536)
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd,mask,cookie,length = self.EVENT.unpack_from(buf,pos)
+            pos += self.EVENT.size
+            name = buf[pos:pos+length].rstrip("\0")
+            pos += length
+            if mask & self.OVERFLOW:
+                events.extend((path,None) for path in self.paths)
+            elif name.endswith(".md") and wd in self.__wds:
+                events.append((self.__wds[wd],name.decode("UTF-8")))
+        return events
+
+    ##
+    # \brief sync the changed files
+    # \param pending dict of path: set of file names, None to rescan the path
+    def __flush(self,pending):
+        for path,names in pending.items():
+            if names is None:
+                self.db.updateDB(path)
+            else:
+                self.db.syncFiles(path,sorted(names))
+        self.__clean()
+
+    ##
+    # \brief polling loop
+    def __poll(self):
+        while self.__running:
+            if self.__select([self.__wake[0]],self.interval):
+                os.read(self.__wake[0],512)
+                continue
+            if not self.__running: # stopped by a signal handler
+                break
+            for path in self.paths:
+                self.db.updateDB(path)
+            self.__clean()
+
+    ##
+    # \brief remove the tags the last sync left without Notes
+    def __clean(self):
+        self.db.cleanTag()
+        self.db.commit()
+
 ##
 # \fn main()
-# for testing
+# command line entry point: sync directories into a database
 def main():
-    #a = Note("./","rules.md")
-    #s = a.forDB()
+    parser = argparse.ArgumentParser(description="Note Organizer")
+    parser.add_argument("paths",nargs="*",default=["./"],help="directories of md files")
+    parser.add_argument("--db",default="test.db",help="database file")
+    parser.add_argument("--workers",type=int,default=1,help="parsing processes")
+    parser.add_argument("--recursive",action="store_true",help="also scan sub-directories")
+    parser.add_argument("--profile",action="store_true",help="print time spent per ingest stage")
+    parser.add_argument("--profile-files",type=int,default=0,metavar="N",
+                        help="with --profile, cProfile the N slowest files")
+    parser.add_argument("--import",dest="load",metavar="FILE",
+                        help="read Notes from a JSONL(.gz) file before the sync")
+    parser.add_argument("--export",metavar="FILE",
+                        help="write all Notes to a JSONL(.gz) file after the sync")
+    parser.add_argument("--verbose",action="store_true",help="print every inserted, updated or deleted file")
+    parser.add_argument("--quiet",action="store_true",help="print warnings and errors only")
+    parser.add_argument("--no-color",action="store_true",help="print without ANSI colors")
+    args = parser.parse_args()
+    configureLog(args.verbose,args.quiet,not args.no_color)
 
-    a=NoteDB("test.db")
-    a.updateDB("./")
+    a=NoteDB(args.db)
+    if args.profile:
+        startProfile(args.profile_files)
+    if args.load:
+        a.importJSON(args.load,workers=args.workers)
+    a.updateTree(args.paths,recursive=args.recursive,workers=args.workers)
     a.cleanTag()
+    a.commit()
+    if args.export:
+        a.exportJSON(args.export,workers=args.workers)
+    if args.profile:
+        print stopProfile().report()
     s = a.fetchNoteName()
     for i in s:
         print i[0],i[1]
@@ -532,4 +2529,3 @@ def main():
         
 if __name__=="__main__":
     main()
-
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package noteparity
+#
+#  \brief Check the Note parser against the line by line parser it replaced
+#
+#  Random notes are generated with the quirks real headers have (upper or
+#  lower case names, half or full width colons, repeated and mixed tag
+#  separators, CRLF, lines without "+", headers longer than a block,
+#  broken headers and dates, empty bodies), then parsed by Note through
+#  all its entry points:
+#
+#  + file: Note(path,filename)
+#  + header: Note(path,filename,headerOnly=True), content read afterwards
+#  + lines: Note(path,filename,fulltext=lines) with byte string lines
+#  + unicode: the same with unicode lines
+#
+#  Each result (fields and content, or the failure) must be the one of
+#  ReferenceNote, a copy of the parser as it was before the single buffer
+#  parsing, given the same input.
+#
+#  Usage:
+#
+#  > python noteparity.py --count 3000 --seed 2014
+#
+
+import os
+import re
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+from StringIO import StringIO
+from time import localtime, strptime
+
+import noteorg
+from systools import *
+
+##
+# \brief the line by line header parser Note used to have
+#
+#  Kept as it was, quirks included, as the reference of the parity check.
+class ReferenceNote(object):
+    ##
+    # \brief parse a whole note
+    # \param fulltext list of lines, as readlines() gives them
+    # \param fromFile if set, start from the defaults of a Note read from a
+    #   file, a Note given its lines has only the fields of its header
+    def __init__(self,fulltext,fromFile=True):
+        if fromFile:
+            self.author = unicode("EMPTY")
+            self.dateCreate = None
+            self.dateChange = None
+            self.tags = []
+            self.ctags = []
+        if len(fulltext) == 0:
+            raise Exception("!! File is empty")
+        ii = self.__phraseHeader(fulltext[0],iter(fulltext[1:]))
+        if len(fulltext) == ii+2:
+            raise Exception("!! Empty Content !!")
+        self.content = unicode("".join(fulltext[ii+2:]))
+
+    def __phraseHeader(self,first,lines):
+        if first.strip(NEWLINE) != "<!--":
+            raise Exception("!! Fail to recognize header from: %s"
+                            %first.strip(NEWLINE))
+        finishFlag = False
+        for ii,line in enumerate(lines):
+            if (line.strip(NEWLINE) == "-->"):
+                finishFlag = ii
+                break
+            currentName = ''
+            if line[0] == '+':
+                ia = line.find(':')
+                ib = line.find("：")
+                if not (ia & ib):
+                    raise Exception("!! Not seperator in header !!")
+                ia = ia if ia != -1 else 100000
+                ib = ib if ib != -1 else 100000
+                if ib > ia:
+                    currentName = line[1:ia]
+                    self.__populateHeaderObj(currentName,line[ia+1:])
+                else:
+                    currentName = line[1:ib]
+                    self.__populateHeaderObj(currentName,line[ib+3:])
+            elif currentName != '':
+                self.__populateHeaderObj(currentName,line)
+        if not finishFlag:
+            raise Exception("!! Unfinished header !!")
+        return finishFlag
+
+    def __populateHeaderObj(self,name,content):
+        content = content.strip()
+        if name.lower() == "author":
+            self.author = unicode(content)
+        if name.lower() == "date created":
+            if content == "":
+                self.dateCreate = localtime()
+            else:
+                self.dateCreate = strptime(content,"%d %b %Y")
+        if name.lower() == "date changed":
+            if content == "":
+                self.dateChange = self.dateCreate
+            else:
+                self.dateChange = strptime(content,"%d %b %Y")
+        if name.lower() == "tags":
+            self.tags = re.split(';+', content)
+            self.tags = [unicode(x.strip().capitalize()) for x in self.tags if x]
+        if name.lower() == "标签":
+            self.ctags = re.split(';+|；+', content)
+            self.ctags = [unicode(x.strip().capitalize()) for x in self.ctags if x]
+
+## header names, the known ones in several cases and unknown ones
+NAMES = ["Author","author","AUTHOR","Date Created","date created","Date Changed",
+         "DATE CHANGED","Tags","tags","TAGS","标签","Status","Title"]
+## tag words, ASCII and Chinese
+TAGWORDS = ["python","Sql","GIT","note book","c++","数据库","物理","笔记","x"]
+## header dates, valid, empty and invalid
+DATES = ["16 Jan 2014","1 Feb 2013","31 dec 2012","","2014-01-16","32 Jan 2014"]
+
+##
+# \brief text of a random note
+# \param rnd random.Random
+# \return byte string
+def randomNote(rnd):
+    lines = []
+    for i in range(rnd.randint(0,8)):
+        name = rnd.choice(NAMES)
+        lower = name.lower()
+        if lower in ("date created","date changed"):
+            value = rnd.choice(DATES) if rnd.random() < 0.05 else DATES[rnd.randint(0,2)]
+        elif lower in ("tags","标签"):
+            seps = [";",";;","; ","；"," ；；"]
+            value = "".join(rnd.choice(TAGWORDS)+rnd.choice(seps) for j in range(rnd.randint(0,5)))
+        else:
+            value = rnd.choice(["刘嘉屹","jiayi liu","a: b","  spaced  ",""])
+        sep = rnd.choice([":"]*12+[" : "]*2+["："]*3+[": x："])
+        if rnd.random() < 0.005:
+            sep = " " # no separator, an error
+        lines.append("+"+name+sep+value)
+        if rnd.random() < 0.1:
+            lines.append(rnd.choice(["continued text","  ","-- not the end","+"+name]))
+    if rnd.random() < 0.1: # longer than the first block
+        lines.append("+Title: "+"x"*rnd.randint(3000,6000))
+    rnd.shuffle(lines)
+    body = rnd.choice(["body\n","正文\n第二行\n","text\n-->\nmore\n","\n","no newline"]*4+[""])
+    text = [rnd.choice(["<!--"]*40+["<!-- ","<--"])]+lines
+    if rnd.random() > 0.02:
+        text.append("-->")
+    newline = "\r\n" if rnd.random() < 0.03 else "\n"
+    return newline.join(text)+newline+body.replace("\n",newline)
+
+##
+# \brief fields of a parsed note, comparable across parsers
+# \param parse function giving a Note or a ReferenceNote
+# \return tuple of the fields and content, or ("error",)
+def outcome(parse):
+    try:
+        note = parse()
+    except Exception:
+        return ("error",)
+    fields = [getattr(note,name,"unset") for name in ("author","dateCreate","dateChange","tags","ctags")]
+    for i in (1,2): # localtime() of an empty date may tick between parsers
+        if fields[i] not in (None,"unset"):
+            fields[i] = tuple(fields[i][:3])
+    return tuple(fields)+(unicode(note.content),)
+
+##
+# \brief parse a note through every entry point of Note
+# \param path directory of the note file, ending with '/'
+# \param text byte string of the note
+# \return list of (entry point, outcome, reference outcome) which differ
+def checkNote(path,text):
+    with open(path+"note.md","w") as f:
+        f.write(text)
+    lines = StringIO(text).readlines()
+    ulines = [line.decode("UTF-8") for line in lines]
+    expected = outcome(lambda: ReferenceNote(lines))
+    lexpected = outcome(lambda: ReferenceNote(lines,False))
+    uexpected = outcome(lambda: ReferenceNote(ulines,False))
+    def header():
+        note = noteorg.Note(path,"note.md",headerOnly=True)
+        note.content # read now
+        return note
+    results = [("file",outcome(lambda: noteorg.Note(path,"note.md")),expected),
+               ("header",outcome(header),expected),
+               ("lines",outcome(lambda: noteorg.Note(path,"note.md",fulltext=lines)),lexpected)]
+    if ulines:
+        results.append(("unicode",outcome(lambda: noteorg.Note(path,"note.md",fulltext=ulines)),uexpected))
+    return [result for result in results if result[1] != result[2]]
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the Note parser against the previous one")
+    parser.add_argument("--count",type=int,default=3000,help="number of random notes")
+    parser.add_argument("--seed",type=int,default=2014,help="random seed")
+    args = parser.parse_args()
+    configureLog(quiet=True,stream=open(os.devnull,"w")) # parse warnings expected
+
+    rnd = random.Random(args.seed)
+    path = tempfile.mkdtemp()+'/'
+    mismatches = 0
+    errors = 0
+    try:
+        for i in range(args.count):
+            text = randomNote(rnd)
+            wrong = checkNote(path,text)
+            if outcome(lambda: ReferenceNote(StringIO(text).readlines())) == ("error",):
+                errors += 1
+            if wrong:
+                mismatches += 1
+                if mismatches <= 5:
+                    print "!! note %d differs:"%i
+                    print text[:300]
+                    for entry,got,expected in wrong:
+                        print "   %-8s %r"%(entry,got)
+                        print "   %-8s %r"%("expected",expected)
+    finally:
+        shutil.rmtree(path)
+    print "%d notes (%d invalid), %d differ"%(args.count,errors,mismatches)
+    sys.exit(1 if mismatches else 0)
+
+if __name__=="__main__":
+    main()
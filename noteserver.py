@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package noteserver
+#
+#  \brief Local query service of a NoteDB
+#
+#  Tools share one database through this service instead of opening their
+#  own connections and contending on the locks.  Queries are answered by a
+#  pool of read-only NoteDB connections, the database is switched to WAL
+#  so that they keep going while the single writer thread syncs notes.
+#
+#  GET requests, answered in JSON:
+#
+#  + /tags?kind=tag: listTags()
+#  + /suggest?prefix=PY[&kind=tag][&limit=10]: suggestTags()
+#  + /files?tag=EXPR[&prefix=1]: getFileByTag()
+#  + /date?since=YYYY-MM-DD&until=YYYY-MM-DD[&field=date_change][&tag=EXPR]: getFileByDate()
+#  + /search?q=WORDS[&limit=20]: search()
+#  + /content?filename=NAME[&path=PATH]: getContent()
+#  + /changed?since=GENERATION: changedSince()
+#  + /stats: pool size, cache counters of the readers
+#
+#  POST /update?path=DIR[&path=DIR...] syncs directories with updateTree()
+#  in the writer thread and answers the new generation.
+#
+#  Usage:
+#
+#  > python noteserver.py --db notes.db --port 8014 --pool 4 <br>
+#  > python noteserver.py --db notes.db --socket /tmp/notes.sock <br>
+#  > python noteserver.py --db notes.db --bench 1 2 4 8 --cache-items 0 <br>
+
+import os
+import sys
+import json
+import socket
+import argparse
+import threading
+import httplib
+import Queue
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from time import time as now
+
+import noteorg
+from systools import *
+
+##
+# \class ReaderPool
+# \brief pool of read-only NoteDB connections
+#
+#  A thread takes a connection with get(), queries it alone and gives it
+#  back with put().  Each connection keeps its own result cache, which is
+#  dropped when the writer commits.
+class ReaderPool:
+    ##
+    # \param filename file name of an existing database
+    # \param size number of connections
+    # \param cacheItems maximum number of cached results per connection
+    def __init__(self,filename,size=4,cacheItems=1024):
+        ## number of connections
+        self.size = size
+        self.__idle = Queue.Queue()
+        self.__all = []
+        for ii in range(size):
+            db = noteorg.NoteDB(filename,cacheItems=cacheItems,readonly=True)
+            self.__all.append(db)
+            self.__idle.put(db)
+
+    ##
+    # \brief take a connection, waiting for one to be free
+    def get(self):
+        return self.__idle.get()
+
+    ##
+    # \brief give a connection back
+    def put(self,db):
+        self.__idle.put(db)
+
+    ##
+    # \brief sum of the cache counters of all connections
+    def cacheStats(self):
+        total = {}
+        for db in self.__all:
+            for key,value in db.cacheStats().items():
+                total[key] = total.get(key,0)+value
+        return total
+
+##
+# \class NoteWriter
+# \brief the single thread writing the database
+#
+#  Writes are queued as functions of the writer NoteDB and run one after
+#  the other.  The database is created if missing and switched to WAL.
+class NoteWriter(threading.Thread):
+    ##
+    # \param filename file name of the database
+    def __init__(self,filename):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.__jobs = Queue.Queue()
+        self.__ready = threading.Event()
+        self.start()
+        self.__ready.wait()
+
+    def run(self):
+        db = noteorg.NoteDB(self.filename,create=True)
+        db.cur.execute("PRAGMA journal_mode = WAL")
+        db.cur.execute("PRAGMA synchronous = NORMAL")
+        self.__ready.set()
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                break
+            func,args,result = job
+            try:
+                value = func(db,*args)
+                db.commit()
+                result.put((value,None))
+            except Exception as inst:
+                db.rollback()
+                result.put((None,inst))
+        db.conn.close()
+
+    ##
+    # \brief run a function in the writer thread and wait for it
+    # \param func function taking the writer NoteDB and args
+    # \return what func returns, its exception is raised again here
+    def call(self,func,*args):
+        result = Queue.Queue(1)
+        self.__jobs.put((func,args,result))
+        value,error = result.get()
+        if error is not None:
+            raise error
+        return value
+
+    ##
+    # \brief stop the thread once the queued writes are done
+    def stop(self):
+        self.__jobs.put(None)
+        self.join()
+
+##
+# \brief sync directories into the database, run by NoteWriter
+# \param db writer NoteDB
+# \param paths list of directories
+# \return generation after the sync
+def _update(db,paths):
+    db.updateTree(paths)
+    db.cleanTag()
+    db.commit()
+    return db.generation
+
+##
+# \class NoteHandler
+# \brief HTTP requests of the query service
+#
+#  HTTP/1.1 keeps the connection of a client open between requests.
+class NoteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    ## path: (reader method, required parameters)
+    QUERIES = {"/tags": ("tags",()),
+               "/suggest": ("suggest",("prefix",)),
+               "/files": ("files",("tag",)),
+               "/date": ("date",()),
+               "/search": ("search",("q",)),
+               "/content": ("content",("filename",)),
+               "/changed": ("changed",())}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = dict((key,values[0]) for key,values in parse_qs(url.query).items())
+        if url.path == "/stats":
+            return self.__reply(200,{"pool": self.server.pool.size,
+                                     "cache": self.server.pool.cacheStats()})
+        if url.path not in self.QUERIES:
+            return self.__reply(404,{"error": "unknown query %s"%url.path})
+        name,required = self.QUERIES[url.path]
+        missing = [key for key in required if key not in args]
+        if missing:
+            return self.__reply(400,{"error": "missing %s"%", ".join(missing)})
+        db = self.server.pool.get()
+        try:
+            value = getattr(self,"_query_"+name)(db,args)
+        except Exception as inst:
+            return self.__reply(400,{"error": inst.args[0]})
+        finally:
+            self.server.pool.put(db)
+        self.__reply(200,value)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.getheader("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if url.path != "/update":
+            return self.__reply(404,{"error": "unknown update %s"%url.path})
+        paths = parse_qs(url.query).get("path")
+        if not paths:
+            return self.__reply(400,{"error": "missing path"})
+        try:
+            gen = self.server.writer.call(_update,paths)
+        except Exception as inst:
+            return self.__reply(400,{"error": inst.args[0]})
+        self.__reply(200,{"generation": gen})
+
+    def _query_tags(self,db,args):
+        return db.listTags(args.get("kind","tag"))
+
+    def _query_suggest(self,db,args):
+        return db.suggestTags(args["prefix"].decode("UTF-8"),args.get("kind"),int(args.get("limit",10)))
+
+    def _query_files(self,db,args):
+        return db.getFileByTag(args["tag"],args.get("prefix") == "1")
+
+    def _query_date(self,db,args):
+        return db.getFileByDate(args.get("since"),args.get("until"),
+                                args.get("field","date_change"),args.get("tag"))
+
+    def _query_search(self,db,args):
+        return db.search(args["q"],limit=int(args.get("limit",20)))
+
+    def _query_content(self,db,args):
+        return db.getContent(args["filename"],args.get("path"))
+
+    def _query_changed(self,db,args):
+        gen,changed,removed = db.changedSince(int(args.get("since",0)))
+        return {"generation": gen, "changed": changed, "removed": removed}
+
+    ##
+    # \brief send a JSON answer
+    # \param code HTTP status
+    # \param value object to encode
+    #
+    #  The status line, headers and body go out in one write: the
+    #  unbuffered wfile would send them one by one, and over TCP the
+    #  next request of a kept-alive connection then waits for a
+    #  delayed ACK (Nagle's algorithm), about 40 ms.
+    def __reply(self,code,value):
+        body = json.dumps(value,ensure_ascii=False)
+        if isinstance(body,unicode):
+            body = body.encode("UTF-8")
+        self.log_request(code)
+        self.wfile.write("%s %d %s\r\n"%(self.protocol_version,code,self.responses[code][0])+
+                         "Server: %s\r\n"%self.version_string()+
+                         "Date: %s\r\n"%self.date_time_string()+
+                         "Content-Type: application/json; charset=utf-8\r\n"+
+                         "Content-Length: %d\r\n\r\n"%len(body)+body)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self,format,*args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self,format,*args)
+
+##
+# \class NoteServer
+# \brief threaded HTTP server over TCP, a thread per client connection
+class NoteServer(ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+
+    ##
+    # \param address (host, port), port 0 picks a free port
+    # \param filename file name of the database, created if missing
+    # \param pool number of read-only connections
+    # \param verbose if set, log every request
+    # \param cacheItems maximum number of cached results per connection
+    def __init__(self,address,filename,pool=4,verbose=False,cacheItems=1024):
+        HTTPServer.__init__(self,address,NoteHandler)
+        _setup(self,filename,pool,verbose,cacheItems)
+
+    ##
+    # \brief stop serving and stop the writer
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self.writer.stop()
+
+##
+# \class UnixNoteServer
+# \brief threaded HTTP server over a Unix socket
+class UnixNoteServer(ThreadingMixIn,UnixStreamServer):
+    daemon_threads = True
+
+    ##
+    # \param address file name of the socket, replaced if it exists
+    # \param filename file name of the database, created if missing
+    # \param pool number of read-only connections
+    # \param verbose if set, log every request
+    # \param cacheItems maximum number of cached results per connection
+    def __init__(self,address,filename,pool=4,verbose=False,cacheItems=1024):
+        if os.path.exists(address):
+            os.remove(address)
+        UnixStreamServer.__init__(self,address,NoteHandler)
+        _setup(self,filename,pool,verbose,cacheItems)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self.writer.stop()
+        os.remove(self.server_address)
+
+##
+# \brief start the writer and the readers of a server
+def _setup(server,filename,pool,verbose,cacheItems):
+    server.verbose = verbose
+    ## the single writer, it also creates a missing database
+    server.writer = NoteWriter(filename)
+    server.pool = ReaderPool(filename,pool,cacheItems)
+
+##
+# \class UnixHTTPConnection
+# \brief httplib connection to a Unix socket
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self,path,timeout=30):
+        httplib.HTTPConnection.__init__(self,"localhost",timeout=timeout)
+        self.socketPath = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+##
+# \brief open a client connection to a server
+# \param address (host, port) or file name of a Unix socket
+def connect(address):
+    if isinstance(address,tuple):
+        return httplib.HTTPConnection(*address)
+    return UnixHTTPConnection(address)
+
+##
+# \brief send queries from concurrent clients
+# \param address (host, port) or file name of a Unix socket
+# \param queries list of request paths, e.g. "/files?tag=Python"
+# \param clients number of client threads, each with a kept-alive connection
+# \param requests number of requests per client
+# \return dict of requests, errors, seconds and rate (requests per second)
+def loadTest(address,queries,clients=8,requests=200):
+    errors = [0]*clients
+    def client(index):
+        conn = connect(address)
+        for ii in range(requests):
+            conn.request("GET",queries[(index*requests+ii)%len(queries)])
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors[index] += 1
+        conn.close()
+    threads = [threading.Thread(target=client,args=(index,)) for index in range(clients)]
+    start = now()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = now()-start
+    return {"requests": clients*requests, "errors": sum(errors),
+            "seconds": seconds, "rate": clients*requests/seconds}
+
+##
+# \brief query mix of a database for loadTest()
+# \param filename file name of the database
+# \param count number of queries
+# \return list of request paths
+#
+#  Pairs of the most used tags, single months, content of Notes and
+#  full-text queries if enabled, each answering a page of results.  The
+#  result caches hold only a part of them, so most requests reach SQLite.
+def benchQueries(filename,count=2000):
+    from urllib import urlencode
+    db = noteorg.NoteDB(filename,readonly=True)
+    tags = [itag for itag,refs in sorted(db.listTags("tag"),key=lambda x: -x[1])[:50]]
+    db.cur.execute("SELECT filename, path FROM head ORDER BY random() LIMIT ?",[count])
+    notes = db.cur.fetchall()
+    db.cur.execute("SELECT DISTINCT substr(date_change,1,7) FROM head")
+    months = [row[0] for row in db.cur.fetchall()] or ["2014-01"]
+    queries = []
+    for ii in range(count):
+        pick = ii%4
+        if pick == 0 and len(tags) > 1:
+            expr = "%s %s"%(tags[ii%len(tags)],tags[(ii*7+1)%len(tags)])
+            queries.append("/files?"+urlencode({"tag": expr}))
+        elif pick == 1 and notes:
+            filename,path = notes[ii%len(notes)]
+            queries.append("/content?"+urlencode({"filename": filename,"path": path}))
+        elif pick == 2 and db.hasSearch and tags:
+            queries.append("/search?"+urlencode({"q": tags[ii%len(tags)].lower(),"limit": 10}))
+        else:
+            month = months[ii%len(months)]
+            queries.append("/date?"+urlencode({"since": month+"-01","until": month+"-31"}))
+    return queries
+
+##
+# \fn main()
+# command line entry point: serve a database, or measure the pool sizes
+def main():
+    parser = argparse.ArgumentParser(description="NoteDB query service")
+    parser.add_argument("--db",default="test.db",help="database file, created if missing")
+    parser.add_argument("--host",default="127.0.0.1",help="address to listen on")
+    parser.add_argument("--port",type=int,default=8014,help="TCP port")
+    parser.add_argument("--socket",help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--pool",type=int,default=4,help="read-only connections")
+    parser.add_argument("--verbose",action="store_true",help="log every request")
+    parser.add_argument("--cache-items",type=int,default=1024,
+                        help="cached results per connection, 0 to make every query reach SQLite")
+    parser.add_argument("--bench",type=int,nargs="*",metavar="POOL",
+                        help="run the load test with these pool sizes and exit")
+    parser.add_argument("--clients",type=int,default=8,help="load test client threads")
+    parser.add_argument("--requests",type=int,default=250,help="load test requests per client")
+    args = parser.parse_args()
+
+    if args.bench is not None:
+        queries = None
+        for size in args.bench or [1,2,4,8]:
+            server = NoteServer((args.host,0),args.db,size,cacheItems=args.cache_items)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            if queries is None:
+                queries = benchQueries(args.db)
+            result = loadTest(server.server_address,queries,args.clients,args.requests)
+            server.close()
+            print "pool %2d: %8.1f req/s, %d requests, %d errors"%(
+                size,result["rate"],result["requests"],result["errors"])
+        return
+    if args.socket:
+        server = UnixNoteServer(args.socket,args.db,args.pool,args.verbose,args.cache_items)
+        warning("Serving %s on %s"%(args.db,args.socket),color=32)
+    else:
+        server = NoteServer((args.host,args.port),args.db,args.pool,args.verbose,args.cache_items)
+        warning("Serving %s on http://%s:%d/"%(args.db,args.host,args.port),color=32)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+if __name__=="__main__":
+    main()
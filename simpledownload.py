@@ -1,67 +1,867 @@
 __author__ = 'jiayiliu'
 
+import argparse
+import codecs
+import hashlib
+import http.client
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
 import urllib.request as ur
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ThreadPoolExecutor, wait
+from collections import deque
+from contextlib import contextmanager
 from html.parser import HTMLParser
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit, urlunsplit
 
 
 class WebPage:
-    def __init__(self, url, isURL=True):
+    META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.I)
+
+    def __init__(self, url, isURL=True, stream=False, encoding=None, cache=None, timeout=None):
         """
         Create connection to read html page.
         :param url: URL or file path
         :param isURL: True for URL, False for file
+        :param stream: True to leave the page unread, to be read with chunks()
+        :param encoding: charset of the page, by default the one declared by
+            the response or the page, else utf-8
+        :param cache: HTTPCache to revalidate the page against, if given
+        :param timeout: socket timeout in seconds, the global default if None
         :return: Webpage class contains html source content
         """
+        self.url = url
+        self.encoding = encoding
+        self.cached = False
         if isURL:
-            self.web = ur.urlopen(url)
-            self.doc = str(self.web.read())
+            headers = cache.conditional(url) if cache is not None else {}
+            while True:
+                try:
+                    if timeout is None:
+                        self.web = ur.urlopen(ur.Request(url, headers=headers))
+                    else:
+                        self.web = ur.urlopen(ur.Request(url, headers=headers), timeout=timeout)
+                except HTTPError as e:
+                    if e.code != 304 or not headers:
+                        raise
+                    e.close()
+                    entry = cache.open(url)
+                    if entry is None:  # evicted since conditional(), fetch it again
+                        headers = {}
+                        continue
+                    self.web = None
+                    self.cached = True
+                    self._source, charset = entry
+                break
+            if self.web is not None:
+                self.url = self.web.geturl()  # after redirects
+                charset = self.web.headers.get_content_charset()
+                self._source = cache.record(url, self.web) if cache is not None else self.web
+            self.encoding = encoding or charset
         else:
-            with open(url, 'r') as f:
-                self.doc = ''.join(f.readlines())
+            self._source = open(url, 'rb')
+        if not stream:
+            self.doc = ''.join(self.chunks())
+
+    def chunks(self, chunk_size=1 << 16):
+        """
+        read and decode the page as it arrives, can be read once
+
+        :param chunk_size: maximum bytes read at a time
+        :return: generator of str
+        """
+        read = getattr(self._source, 'read1', self._source.read)
+        try:
+            block = read(chunk_size)
+            if self.encoding is None:
+                while block and len(block) < 1024:  # enough for a <meta> tag
+                    more = read(chunk_size)
+                    if not more:
+                        break
+                    block += more
+                self.encoding = self.sniff(block)
+            try:
+                decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+            except LookupError:
+                self.encoding = 'utf-8'
+                decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+            while block:
+                text = decoder.decode(block)
+                if text:
+                    yield text
+                block = read(chunk_size)
+            text = decoder.decode(b'', final=True)
+            if text:
+                yield text
+        finally:
+            self._source.close()
+
+    def close(self):
+        """
+        close a page left unread
+        """
+        self._source.close()
+
+    @classmethod
+    def sniff(cls, head):
+        """
+        charset of a page from its byte order mark or <meta> tag
+
+        :param head: first bytes of the page
+        :return: codec name, utf-8 if not declared
+        """
+        if head.startswith(codecs.BOM_UTF8):
+            return 'utf-8-sig'
+        match = cls.META_CHARSET.search(head)
+        return match.group(1).decode('ascii') if match else 'utf-8'
 
 
 class TargetHTMLParser(HTMLParser):
-    def __init__(self, is_target):
+    def __init__(self, is_target, base=None):
         """
         Create HTML Parser to extract download file list
 
         :param is_target: function to determine whether to download file
+        :param base: URL of the page, to resolve relative links against
         :return:
         """
         super().__init__()
         self.download = []
+        self.follow = []
         self.is_target = is_target
+        self.base = base
 
     def handle_starttag(self, tag, attrs):
         if tag != "a":
             return
         for attr in attrs:
-            if 'href' != attr[0]:
+            if 'href' != attr[0] or not attr[1]:
+                continue
+            link = urljoin(self.base, attr[1]) if self.base else attr[1]
+            if self.is_target(link):
+                self.download.append(link)
+            else:
+                self.follow.append(link)
+
+    def links(self, chunks):
+        """
+        feed the page piece by piece and yield target links as they are found
+
+        :param chunks: iterable of str, e.g. WebPage.chunks()
+        :return: generator of links, also collected in self.download
+        """
+        found = len(self.download)
+        for chunk in chunks:
+            self.feed(chunk)
+            while found < len(self.download):
+                yield self.download[found]
+                found += 1
+        self.close()
+        while found < len(self.download):
+            yield self.download[found]
+            found += 1
+
+
+class ConnectionPool:
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, per_host=2, timeout=30, max_redirects=5):
+        """
+        Keep-alive HTTP connections shared by download threads
+
+        :param per_host: maximum number of requests in flight per host
+        :param timeout: socket timeout in seconds
+        :param max_redirects: maximum number of redirects followed
+        """
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    @contextmanager
+    def get(self, url, headers=None):
+        """
+        GET a URL on a kept-alive connection to its host
+
+        :param url: http or https URL
+        :param headers: dict of extra request headers
+        :return: context manager of the http.client.HTTPResponse, after redirects
+        """
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError('unsupported URL %s' % url)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            with self._slot(key):
+                conn, response = self._request(key, path, headers or {})
+                location = response.getheader('Location')
+                if response.status in self.REDIRECTS and location:
+                    response.read()
+                    self._release(key, conn, response)
+                    url = urljoin(url, location)
+                    continue
+                try:
+                    yield response
+                finally:
+                    self._release(key, conn, response)
+                return
+        raise http.client.HTTPException('too many redirects for %s' % url)
+
+    def close(self):
+        """
+        close the idle connections
+        """
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.per_host)
+            return self._slots[key]
+
+    def _request(self, key, path, headers):
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()  # closed by the server while idle
+        scheme, netloc = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        conn.request('GET', path, headers=headers)
+        return conn, conn.getresponse()
+
+    def _release(self, key, conn, response):
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+
+
+class HostScheduler:
+    def __init__(self, per_host=2, delay=0.0):
+        """
+        Start tasks on executors with at most per_host of them in flight per
+        host and delay seconds between two starts on a host.  Tasks wait in
+        per-host queues rather than in the executors, so the workers never
+        sit on a busy host.  Shared by a Crawler and a DownloadManager, it
+        limits the pages and files of a host together.  Thread safe.
+
+        :param per_host: maximum number of tasks in flight per host
+        :param delay: minimum seconds between two starts on a host
+        """
+        self.per_host = per_host
+        self.delay = delay
+        self._lock = threading.RLock()  # an executor may run a done callback at once
+        self._queues = {}
+        self._running = {}
+        self._next = {}
+        self._timers = {}
+
+    def submit(self, executor, host, fn, *args, **kwargs):
+        """
+        queue fn(*args, **kwargs) for executor until host allows it
+
+        :param executor: concurrent.futures executor to run the task on
+        :param host: host the task talks to, e.g. URL netloc
+        :return: Future of the task, cancel() drops it while it is queued
+        """
+        future = Future()
+        with self._lock:
+            self._queues.setdefault(host, deque()).append((future, executor, fn, args, kwargs))
+            self._running.setdefault(host, 0)
+            self._launch(host)
+        return future
+
+    def _launch(self, host):
+        queue = self._queues[host]
+        while queue and self._running[host] < self.per_host:
+            now = time.time()
+            ready = self._next.get(host, now)
+            if ready > now:
+                if host not in self._timers:
+                    self._timers[host] = threading.Timer(ready - now, self._wake, (host,))
+                    self._timers[host].daemon = True
+                    self._timers[host].start()
+                return
+            future, executor, fn, args, kwargs = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._running[host] += 1
+            self._next[host] = now + self.delay
+            try:
+                task = executor.submit(fn, *args, **kwargs)
+            except RuntimeError as e:  # executor shut down
+                self._running[host] -= 1
+                future.set_exception(e)
                 continue
-            if is_target(attr[1]):
-                self.download.append(attr[1])
+            task.add_done_callback(lambda task, future=future, host=host: self._done(host, future, task))
+
+    def _wake(self, host):
+        with self._lock:
+            del self._timers[host]
+            self._launch(host)
+
+    def _done(self, host, future, task):
+        with self._lock:
+            self._running[host] -= 1
+            self._launch(host)
+        if task.cancelled():
+            future.set_exception(CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+class HTTPCache:
+    def __init__(self, path='./.webcache', max_bytes=64 << 20):
+        """
+        Validators (ETag, Last-Modified, size) of fetched pages and files
+        in path/cache.db, and the bodies of pages under path/pages, for
+        conditional requests on later runs.  Thread safe.
+
+        :param path: cache directory
+        :param max_bytes: maximum total size of the cached pages, the least
+            recently used are evicted beyond it
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(path, 'pages'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, 'cache.db'),
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entry (url TEXT PRIMARY KEY, kind TEXT, '
+                         'file TEXT, etag TEXT, modified TEXT, size INTEGER, charset TEXT, '
+                         'accessed REAL)')
+
+    def conditional(self, url, file=None):
+        """
+        request headers to revalidate a cached page, or a downloaded file
+
+        :param url: URL fetched before
+        :param file: local file the URL was downloaded to, None for a page
+        :return: dict of If-None-Match / If-Modified-Since, empty if the
+            local copy is missing or differs from the one recorded
+        """
+        with self._lock:
+            row = self._db.execute('SELECT file, etag, modified, size FROM entry WHERE url=?',
+                                   (url,)).fetchone()
+        if row is None or (file is not None and row[0] != file):
+            return {}
+        name, etag, modified, size = row
+        if not os.path.exists(name) or os.path.getsize(name) != size:
+            return {}
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        return headers
+
+    def open(self, url):
+        """
+        open the cached body of a page
+
+        :param url: page URL
+        :return: (binary file, charset declared when it was fetched), None if
+            the page was evicted, possibly after conditional() was called
+        """
+        with self._lock:
+            row = self._db.execute('SELECT file, charset FROM entry WHERE url=?', (url,)).fetchone()
+            if row is None:
+                return None
+            name, charset = row
+            try:
+                source = open(name, 'rb')  # under the lock, _evict() removes files
+            except FileNotFoundError:
+                return None
+            self._db.execute('UPDATE entry SET accessed=? WHERE url=?', (time.time(), url))
+        return source, charset
+
+    def record(self, url, response):
+        """
+        wrap a page response to store its body while it is read
+
+        :param url: page URL
+        :param response: http.client.HTTPResponse
+        :return: file-like read in place of the response, stored in the
+            cache once read to the end and closed
+        """
+        if not (response.getheader('ETag') or response.getheader('Last-Modified')):
+            return response  # cannot be revalidated
+        return _Recorder(self, url, response)
+
+    def store(self, url, file, response, kind='file'):
+        """
+        record the validators of a complete page or file
+
+        :param url: URL fetched
+        :param file: local copy
+        :param response: http.client.HTTPResponse it was fetched with
+        :param kind: 'page' or 'file', only pages are evicted
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO entry VALUES (?,?,?,?,?,?,?,?)', (
+                url, kind, file, response.getheader('ETag'), response.getheader('Last-Modified'),
+                os.path.getsize(file), response.headers.get_content_charset(), time.time()))
+            if kind == 'page':
+                self._evict()
+
+    def _evict(self):
+        total = self._db.execute("SELECT TOTAL(size) FROM entry WHERE kind='page'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, name, size in self._db.execute("SELECT url, file, size FROM entry "
+                                                "WHERE kind='page' ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM entry WHERE url=?', (url,))
+            if os.path.exists(name):
+                os.remove(name)
+            total -= size
+
+    def close(self):
+        self._db.close()
+
+
+class _Recorder:
+    def __init__(self, cache, url, response):
+        self.cache = cache
+        self.url = url
+        self.response = response
+        self.file = os.path.join(cache.path, 'pages', hashlib.sha1(url.encode()).hexdigest())
+        self._temp = '%s.%d.tmp' % (self.file, threading.get_ident())
+        self._out = open(self._temp, 'wb')
+        self._done = False
+
+    def read(self, amt=None):
+        return self._copy(self.response.read(amt))
+
+    def read1(self, amt=-1):
+        return self._copy(self.response.read1(amt))
+
+    def _copy(self, data):
+        if data:
+            self._out.write(data)
+        else:
+            self._done = True
+        return data
+
+    def close(self):
+        self.response.close()
+        self._out.close()
+        if self._done:
+            os.replace(self._temp, self.file)
+            self.cache.store(self.url, self.file, self.response, 'page')
+        else:
+            os.remove(self._temp)
 
 
 class downloadFile():
-    def __init__(self, link, path='./', file=None):
+    def __init__(self, link, path='./', file=None, size=None, checksum=None, algorithm='sha256'):
         """
         initiate download file class
 
         :param link: download url
         :param path: download path, default ./
         :param file: download file default url file name
+        :param size: expected size in bytes, checked if given
+        :param checksum: expected hex digest of the file, checked if given
+        :param algorithm: hashlib name of the checksum
         """
         if file is None:
             self.file = path + link.split('/')[-1]
         else:
             self.file = path + file
         self.link = link
+        self.part = self.file + '.part'
+        self.size = size
+        self.checksum = checksum
+        self.algorithm = algorithm
+        self.unchanged = False
 
-    def download(self):
+    def download(self, pool=None, chunk_size=1 << 16, retries=3, cache=None):
         """
         initiate downloading
+
+        The file is streamed to file.part, which is renamed to file once
+        complete and checked.  A .part left by an interrupted transfer is
+        resumed with a Range request, also when the connection drops
+        during this call (up to retries times).  With a cache, a file
+        already downloaded is only fetched again if the server says it
+        changed, otherwise self.unchanged is set.
+
+        :param pool: ConnectionPool to stream the file on, a private one if None
+        :param chunk_size: bytes read at a time
+        :param retries: number of resumes after a dropped connection
+        :param cache: HTTPCache recording the file, if given
+        :return: number of bytes transferred
+        """
+        if urlsplit(self.link).scheme not in ('http', 'https'):
+            ur.urlretrieve(self.link, self.part)
+            self._finish()
+            return os.path.getsize(self.file)
+        headers = {}
+        if cache is not None and not os.path.exists(self.part):
+            headers = cache.conditional(self.link, self.file)
+        own = pool is None
+        if own:
+            pool = ConnectionPool(1)
+        self.transferred = 0
+        self.response = None
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    self._fetch(pool, chunk_size, headers)
+                    break
+                except (http.client.IncompleteRead, ConnectionError, TimeoutError) as e:
+                    if attempt == retries:
+                        raise
+        finally:
+            if own:
+                pool.close()
+        if self.unchanged:
+            return self.transferred
+        self._finish()
+        if cache is not None and self.response is not None:
+            cache.store(self.link, self.file, self.response)
+        return self.transferred
+
+    def _fetch(self, pool, chunk_size, validators=None):
+        """
+        stream the missing part of the file into file.part, counting the
+        bytes in self.transferred, or set self.unchanged if the server
+        answers 304 to the validators of a complete file
+        """
+        offset = os.path.getsize(self.part) if os.path.exists(self.part) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else dict(validators or {})
+        with pool.get(self.link, headers) as response:
+            if response.status == 304:
+                response.read()
+                self.unchanged = True
+                return
+            if response.status == 416:  # nothing left after offset
+                response.read()
+                total = response.getheader('Content-Range', '').rpartition('/')[2]
+                if total.isdigit() and int(total) == offset:
+                    return
+            else:
+                if response.status == 206:
+                    span, _, total = response.getheader('Content-Range', '').partition('/')
+                    if span.split(' ')[-1].split('-')[0] != str(offset):
+                        response.read()
+                        raise http.client.HTTPException('bad Content-Range for %s' % self.link)
+                    if self.size is None and total.isdigit():
+                        self.size = int(total)
+                    mode = 'ab'
+                elif response.status == 200:  # whole file, Range not supported
+                    if self.size is None:
+                        self.size = response.length
+                    mode = 'wb'
+                else:
+                    response.read()
+                    raise http.client.HTTPException('HTTP %d for %s' % (response.status, self.link))
+                self.response = response
+                with open(self.part, mode) as f:
+                    for chunk in iter(lambda: response.read(chunk_size), b''):
+                        f.write(chunk)
+                        self.transferred += len(chunk)
+                if response.length:  # connection closed before the end
+                    raise http.client.IncompleteRead(b'', response.length)
+                return
+        os.remove(self.part)  # longer than the file, not the same file any more
+        self._fetch(pool, chunk_size)
+
+    def _finish(self):
+        """
+        check file.part against the expected size and checksum, then rename it
+        """
+        size = os.path.getsize(self.part)
+        if self.size is not None and size != self.size:
+            if size > self.size:  # cannot be resumed
+                os.remove(self.part)
+            raise http.client.IncompleteRead(b'', self.size - size)
+        if self.checksum is not None:
+            digest = hashlib.new(self.algorithm)
+            with open(self.part, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            if digest.hexdigest() != self.checksum.lower():
+                os.remove(self.part)
+                raise ValueError('%s checksum mismatch for %s' % (self.algorithm, self.link))
+        os.replace(self.part, self.file)
+
+
+class DownloadManager:
+    def __init__(self, workers=8, per_host=2, timeout=30, cache=None, scheduler=None):
+        """
+        Download many files at once
+
+        :param workers: maximum number of downloads in flight
+        :param per_host: maximum number of downloads in flight per host
+        :param timeout: socket timeout in seconds
+        :param cache: HTTPCache to skip the files that did not change
+        :param scheduler: HostScheduler shared with a Crawler, in place of
+            per_host, so pages and files of a host count together
+        """
+        self.workers = workers
+        self.scheduler = scheduler or HostScheduler(per_host)
+        self.pool = ConnectionPool(self.scheduler.per_host, timeout)
+        self.cache = cache
+
+    def download(self, files, path='./'):
+        """
+        download files with bounded concurrency
+
+        :param files: iterable of downloadFile or links, the same link
+            (after normalize_url()) is downloaded once; each download starts
+            as soon as it is taken and its host has a free slot, so a
+            generator such as TargetHTMLParser.links() overlaps parsing and
+            downloading
+        :param path: download path of links
+        :return: dict of files, unchanged, bytes, seconds, rate (bytes/s)
+            and failed, the list of (link, error)
+
+        A link whose file name is already taken by another link, like
+        /2019/paper.pdf and /2020/paper.pdf, is saved as name-HASH.ext with
+        a hash of the link, so it keeps its name from run to run.  A
+        downloadFile whose file is taken fails with a name collision.
+        """
+        result = {'files': 0, 'unchanged': 0, 'bytes': 0, 'failed': []}
+        start = time.time()
+        futures = {}
+        with ThreadPoolExecutor(self.workers) as executor:
+            seen = set()
+            names = set()
+            for f in files:
+                link = f.link if isinstance(f, downloadFile) else f
+                try:
+                    key = normalize_url(link)
+                except ValueError:  # bad port, left to the download to report
+                    key = link
+                if key in seen:
+                    continue
+                seen.add(key)
+                if not isinstance(f, downloadFile):
+                    f = downloadFile(link, path=path)
+                    if f.file in names:
+                        name, ext = os.path.splitext(link.split('/')[-1])
+                        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+                        f = downloadFile(link, path=path, file='%s-%s%s' % (name, digest, ext))
+                if f.file in names:
+                    result['failed'].append((f.link, ValueError('name collision on %s' % f.file)))
+                    continue
+                names.add(f.file)
+                future = self.scheduler.submit(executor, urlsplit(f.link).netloc,
+                                               f.download, self.pool, cache=self.cache)
+                futures[future] = f
+            wait(futures)
+        for future, f in futures.items():
+            try:
+                result['bytes'] += future.result()
+                result['files'] += 1
+                result['unchanged'] += f.unchanged
+            except Exception as e:
+                result['failed'].append((f.link, e))
+        self.pool.close()
+        result['seconds'] = time.time() - start
+        result['rate'] = result['bytes'] / result['seconds'] if result['seconds'] > 0 else 0.0
+        return result
+
+    @staticmethod
+    def report(result):
+        """
+        one line summary of download()
+
+        :param result: dict returned by download()
+        :return: string
+        """
+        return '%d files (%d unchanged), %.1f MB in %.2fs (%.2f MB/s), %d failed' % (
+            result['files'], result['unchanged'], result['bytes'] / 1e6, result['seconds'],
+            result['rate'] / 1e6, len(result['failed']))
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """
+    canonical form of a URL to compare links by: lower case scheme and
+    host, no default port, user info or fragment, '/' for an empty path
+
+    :param url: absolute URL
+    :return: normalized URL
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''
+    if ':' in host:
+        host = '[%s]' % host
+    port = parts.port
+    if port is not None and DEFAULT_PORTS.get(scheme) != port:
+        host = '%s:%d' % (host, port)
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=1e-4):
+        """
+        Set of strings in fixed memory, with false positives
+
+        :param capacity: number of items expected
+        :param error_rate: false positive rate at capacity
         """
-        ur.urlretrieve(self.link, self.file)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for p in self._positions(item):
+            self._bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+
+class Crawler:
+    HTML = ('text/html', 'application/xhtml+xml')
+
+    def __init__(self, is_target, depth=2, domains=None, workers=8, per_host=2,
+                 delay=0.0, bloom=None, cache=None, timeout=30, scheduler=None):
+        """
+        Follow the links of a site and collect the download targets
+
+        :param is_target: function to determine whether to download file
+        :param depth: number of links followed from the seed pages
+        :param domains: hosts to crawl, subdomains included, by default the
+            hosts of the seed pages
+        :param workers: maximum number of pages fetched at once
+        :param per_host: maximum number of pages fetched at once per host
+        :param delay: minimum seconds between two requests to a host
+        :param bloom: number of URLs expected, to remember the URLs seen in a
+            BloomFilter instead of a set
+        :param cache: HTTPCache to revalidate the pages against, if given
+        :param timeout: socket timeout in seconds
+        :param scheduler: HostScheduler shared with a DownloadManager, in
+            place of per_host and delay, so pages and files of a host count
+            together
+        """
+        self.is_target = is_target
+        self.depth = depth
+        self.domains = domains
+        self.workers = workers
+        self.scheduler = scheduler or HostScheduler(per_host, delay)
+        self.seen = BloomFilter(bloom) if bloom else set()
+        self.cache = cache
+        self.timeout = timeout
+        self.pages = 0
+        self.failed = []
+
+    def crawl(self, seeds):
+        """
+        crawl breadth first from the seed pages
+
+        :param seeds: URL or list of URLs
+        :return: generator of target links as they are found, each once,
+            e.g. for DownloadManager.download()
+        """
+        seeds = [normalize_url(url) for url in ([seeds] if isinstance(seeds, str) else seeds)]
+        domains = self.domains or {urlsplit(url).hostname for url in seeds}
+        executor = ThreadPoolExecutor(self.workers)
+        pending = {}
+
+        def enqueue(url, depth):
+            pending[self.scheduler.submit(executor, urlsplit(url).netloc, self._visit, url)] = (url, depth)
+
+        try:
+            for url in seeds:
+                if url not in self.seen:
+                    self.seen.add(url)
+                    enqueue(url, 0)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, depth = pending.pop(future)
+                    try:
+                        targets, links = future.result()
+                    except Exception as e:
+                        self.failed.append((url, e))
+                        continue
+                    self.pages += 1
+                    for link in targets:
+                        link = self._new(link)
+                        if link:
+                            yield link
+                    if depth >= self.depth:
+                        continue
+                    for link in links:
+                        link = self._new(link, domains)
+                        if link:
+                            enqueue(link, depth + 1)
+        finally:
+            for future in pending:  # left queued in the scheduler
+                future.cancel()
+            executor.shutdown(cancel_futures=True)
+
+    def _new(self, link, domains=None):
+        """
+        normalized link if it was not seen before and is in scope, else None
+        """
+        try:
+            link = normalize_url(link)
+        except ValueError:  # bad port
+            return None
+        parts = urlsplit(link)
+        if parts.scheme not in DEFAULT_PORTS or link in self.seen:
+            return None
+        if domains is not None and not any(parts.hostname == d or parts.hostname.endswith('.' + d)
+                                           for d in domains):
+            return None
+        self.seen.add(link)
+        return link
+
+    def _visit(self, url):
+        """
+        fetch and parse a page
+
+        :return: (target links, other links)
+        """
+        page = WebPage(url, stream=True, cache=self.cache, timeout=self.timeout)
+        if page.web is not None and page.web.headers.get_content_type() not in self.HTML:
+            page.close()
+            return [], []
+        parser = TargetHTMLParser(self.is_target, base=page.url)
+        for chunk in page.chunks():
+            parser.feed(chunk)
+        parser.close()
+        return parser.download, parser.follow
+
 
 def is_target(url):
     """
@@ -69,14 +869,39 @@ def is_target(url):
     :param url: download link to be determined
     :return: True / False
     """
-    if name[-3:] == 'pdf' and name[:4] == 'http':
+    if url[-3:] == 'pdf' and url[:4] == 'http':
         return True
     else:
         return False
 
 if __name__ == "__main__":
-    w = WebPage("./temp.html", isURL=False)
-    parser = TargetHTMLParser(is_target)
-    parser.feed(w.doc)
-    for name in parser.download:
-        downloadFile(name, path='./').download()
\ No newline at end of file
+    argparser = argparse.ArgumentParser(description='download the files linked from a page')
+    argparser.add_argument('page', nargs='?', default='./temp.html', help='URL or html file')
+    argparser.add_argument('--path', default='./', help='download path')
+    argparser.add_argument('--workers', type=int, default=8, help='downloads in flight')
+    argparser.add_argument('--per-host', type=int, default=2, help='requests in flight per host, pages and files')
+    argparser.add_argument('--cache', help='cache directory to revalidate pages and files with')
+    argparser.add_argument('--crawl', type=int, metavar='DEPTH',
+                           help='follow links of the page URL up to DEPTH')
+    argparser.add_argument('--domain', action='append', help='host to crawl, the page host by default')
+    argparser.add_argument('--delay', type=float, default=0.0, help='seconds between requests to a host')
+    argparser.add_argument('--bloom', type=int, metavar='N', help='remember N crawled URLs in a Bloom filter')
+    args = argparser.parse_args()
+    cache = HTTPCache(args.cache) if args.cache else None
+    scheduler = HostScheduler(args.per_host, args.delay)  # pages and files of a host together
+    manager = DownloadManager(args.workers, cache=cache, scheduler=scheduler)
+    if args.crawl is not None:
+        crawler = Crawler(is_target, args.crawl, args.domain, args.workers,
+                          bloom=args.bloom, cache=cache, scheduler=scheduler)
+        result = manager.download(crawler.crawl(args.page), path=args.path)
+        for link, error in crawler.failed:
+            print('failed %s: %s' % (link, error))
+        print('%d pages crawled' % crawler.pages)
+    else:
+        isURL = args.page.startswith(('http://', 'https://'))
+        w = WebPage(args.page, isURL=isURL, stream=True, cache=cache)
+        parser = TargetHTMLParser(is_target, base=w.url if isURL else None)
+        result = manager.download(parser.links(w.chunks()), path=args.path)
+    for link, error in result['failed']:
+        print('failed %s: %s' % (link, error))
+    print(DownloadManager.report(result))
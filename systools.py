@@ -4,6 +4,23 @@
 # quick tools for general purposes
 #
 
+import hashlib
+import os
+import sys
+import atexit
+from time import time as now
+import heapq
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatch
+from collections import OrderedDict
+try:
+    from os import scandir
+except ImportError: # python 2, use the backport if installed
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 ## 
 #  \brief Create warning message in red
 #  \param message a string of warning message
@@ -20,12 +37,434 @@
 #  | 32 | green |
 #  | 33 | yellow|
 #  --------------
+#
+#  The message goes through the module Logger (see logger below): red
+#  messages are logged as WARNING, the others as INFO.
 def warning(message,color=31):
-    ## Define warning color
-    cWARNING = '\033[%dm'%color
-    ## Define Normal color
-    ENDC = '\033[0m'
-    print cWARNING+message+ENDC
-    
+    logger.log(WARNING if color == 31 else INFO,message,color)
+
+## levels of Logger
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+##
+#  \brief level-aware message sink with buffering and event counters
+#
+#  Messages below the level are dropped before being formatted.  DEBUG
+#  lines are kept in a buffer and written in one call when it is full,
+#  when flushEvery seconds passed, with the next message of a higher
+#  level, and at exit.
+#
+#  Per-file messages are logged with event(): the message is only shown
+#  at DEBUG level, while the event is counted for the progress line
+#  (every progressEvery seconds) and the summary line.
+class Logger(object):
+    ##
+    #  \param level minimum level written
+    #  \param color if set, wrap the messages in ANSI colors
+    #  \param stream file object written to, sys.stdout if None
+    #  \param bufferLines number of lines buffered, 0 to write every line
+    #  \param flushEvery maximum seconds a line stays in the buffer
+    #  \param progressEvery seconds between two progress lines, 0 for none
+    def __init__(self,level=INFO,color=True,stream=None,bufferLines=200,
+                 flushEvery=1.0,progressEvery=2.0):
+        self.level = level
+        self.color = color
+        self.stream = stream
+        self.bufferLines = bufferLines
+        self.flushEvery = flushEvery
+        self.progressEvery = progressEvery
+        ## event: number of times it happened since the last summary
+        self.counts = {}
+        self.__lines = []
+        self.__flushed = now()
+        self.__started = None
+        self.__progressed = None
+
+    ##
+    #  \brief format a message
+    #  \param message the text
+    #  \param color ANSI color id, None for no color
+    def format(self,message,color=None):
+        if self.color and color is not None:
+            return '\033[%dm%s\033[0m\n'%(color,message)
+        return message+'\n'
+
+    ##
+    #  \brief write a message if its level is high enough
+    #  \param level DEBUG, INFO, WARNING or ERROR
+    #  \param message the text
+    #  \param color ANSI color id, see warning()
+    def log(self,level,message,color=None):
+        if level < self.level:
+            return
+        self.__lines.append(self.format(message,color))
+        if level > DEBUG or len(self.__lines) > self.bufferLines \
+           or now()-self.__flushed > self.flushEvery:
+            self.flush()
+
+    def debug(self,message,color=None):
+        self.log(DEBUG,message,color)
+
+    def info(self,message,color=None):
+        self.log(INFO,message,color)
+
+    ##
+    #  \brief count an event, with a message shown at DEBUG level
+    #  \param name name of the event, e.g. "insert"
+    #  \param message per-file message
+    #  \param color ANSI color id of the message
+    def event(self,name,message=None,color=None):
+        if self.__started is None:
+            self.__started = self.__progressed = now()
+        self.counts[name] = self.counts.get(name,0)+1
+        if message is not None and self.level <= DEBUG:
+            self.log(DEBUG,message,color)
+        if self.progressEvery and now()-self.__progressed > self.progressEvery:
+            self.__progressed = now()
+            self.log(INFO,"- "+self.__tally(),34)
+
+    ##
+    #  \brief write the counts since the last summary and reset them
+    #  \param title beginning of the line
+    #  \return the counts
+    def summary(self,title="Done"):
+        counts = self.counts
+        if counts:
+            self.log(INFO,"- %s: %s"%(title,self.__tally()),34)
+        self.counts = {}
+        self.__started = None
+        self.flush()
+        return counts
+
+    def __tally(self):
+        total = sum(self.counts.values())
+        seconds = now()-self.__started
+        return "%s in %.1fs (%.0f/s)"%(
+            ", ".join("%d %s"%(n,name) for name,n in sorted(self.counts.items())),
+            seconds,total/seconds if seconds > 0 else 0.0)
+
+    ##
+    #  \brief write the buffered lines
+    def flush(self):
+        self.__flushed = now()
+        if not self.__lines:
+            return
+        stream = self.stream or sys.stdout
+        stream.write("".join(self.__lines))
+        stream.flush()
+        self.__lines = []
+
+## Logger used by warning() and noteorg
+logger = Logger()
+atexit.register(logger.flush)
+
+##
+#  \brief set up the module logger
+#  \param verbose if set, show DEBUG messages (every file)
+#  \param quiet if set, show only warnings and errors
+#  \param color if set, use ANSI colors
+#  \param stream file object written to, sys.stdout if None
+def configureLog(verbose=False,quiet=False,color=True,stream=None):
+    logger.level = WARNING if quiet else DEBUG if verbose else INFO
+    logger.color = color
+    logger.stream = stream
+
 ## Newline symbol for Linux system
 NEWLINE = '\n'
+
+##
+#  \brief SHA-1 digest of a file
+#  \param filename name of the file
+#  \param blocksize number of bytes read at a time
+#  \return hex digest string
+def fileHash(filename,blocksize=1<<16):
+    h = hashlib.sha1()
+    with open(filename,'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+##
+#  \brief minimal stand-in for os.DirEntry when scandir is not available
+class _DirEntry(object):
+    __slots__ = ("name","path")
+
+    def __init__(self,path,name):
+        self.name = name
+        self.path = os.path.join(path,name)
+
+    def is_dir(self,follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+##
+#  \brief list a directory as DirEntry objects
+#  \param path directory
+def _scandir(path):
+    if scandir is not None:
+        return scandir(path)
+    return [_DirEntry(path,name) for name in os.listdir(path)]
+
+##
+#  \brief walk directories and group the matching files per directory
+#  \param roots list of root directories
+#  \param include fnmatch patterns, a file name must match one of them
+#  \param exclude fnmatch patterns of file and directory names to skip
+#  \param recursive if set, descend into sub-directories (symlinks are not followed)
+#  \param failed list to which the directories (ending with '/') which could
+#   not be listed are appended, nothing is known about their content
+#  \return generator of (directory path ending with '/', {filename: stat result})
+#
+#  With os.scandir (or the scandir backport on python 2) the file type
+#  comes with the directory listing, so only the matching files are
+#  stat'ed.  Only one directory is held in memory at a time.
+def scanTree(roots,include=("*",),exclude=(),recursive=True,failed=None):
+    pending = [os.path.abspath(root) for root in reversed(roots)]
+    while pending:
+        path = pending.pop()
+        files = {}
+        subdirs = []
+        try:
+            entries = _scandir(path)
+        except OSError as inst:
+            warning("!! Fail to list %s: %s"%(path,inst.strerror))
+            if failed is not None:
+                failed.append(path.rstrip('/')+'/')
+            continue
+        for entry in entries:
+            name = entry.name
+            if any(fnmatch(name,pattern) for pattern in exclude):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    subdirs.append(entry.path)
+            elif any(fnmatch(name,pattern) for pattern in include):
+                try:
+                    files[name] = entry.stat()
+                except OSError: # removed while listing
+                    pass
+        yield (path.rstrip('/')+'/',files)
+        pending.extend(sorted(subdirs,reverse=True))
+
+##
+#  \brief rough memory size of a cached value
+#  \param value string, number or nested tuple/list of them
+#  \return size in bytes
+def estimateSize(value):
+    if isinstance(value,(str,unicode,bytearray)):
+        return len(value)+48
+    if isinstance(value,(tuple,list)):
+        return 64+8*len(value)+sum(estimateSize(x) for x in value)
+    return 24
+
+##
+#  \brief bounded least recently used cache
+#
+#  Entries are evicted, least recently used first, when there are more
+#  than maxItems of them or their estimated size exceeds maxBytes.
+#  validate() drops everything when the given token (e.g. a generation
+#  counter of the data source) changed.
+class LRUCache(object):
+    ## returned by get() for a missing key
+    MISSING = object()
+
+    ##
+    #  \param maxItems maximum number of entries
+    #  \param maxBytes maximum estimated size of all entries
+    #  \param sizeof function giving the size of a value
+    def __init__(self,maxItems=1024,maxBytes=16<<20,sizeof=estimateSize):
+        self.maxItems = maxItems
+        self.maxBytes = maxBytes
+        self.sizeof = sizeof
+        ## number of get() answered from the cache
+        self.hits = 0
+        ## number of get() not answered from the cache
+        self.misses = 0
+        ## number of entries evicted by the bounds
+        self.evictions = 0
+        ## estimated size of all entries
+        self.bytes = 0
+        self.__entries = OrderedDict()
+        self.__token = None
+
+    def __len__(self):
+        return len(self.__entries)
+
+    ##
+    #  \brief drop all entries if token changed since the last call
+    #  \return True if the entries were dropped
+    def validate(self,token):
+        if token != self.__token:
+            self.clear()
+            self.__token = token
+            return True
+        return False
+
+    ##
+    #  \brief drop all entries
+    def clear(self):
+        self.__entries.clear()
+        self.bytes = 0
+
+    ##
+    #  \brief look up a key
+    #  \return the value, or MISSING
+    def get(self,key):
+        entry = self.__entries.pop(key,None)
+        if entry is None:
+            self.misses += 1
+            return self.MISSING
+        self.__entries[key] = entry # most recently used last
+        self.hits += 1
+        return entry[0]
+
+    ##
+    #  \brief store a value
+    def put(self,key,value):
+        size = self.sizeof(value)
+        old = self.__entries.pop(key,None)
+        if old is not None:
+            self.bytes -= old[1]
+        if size > self.maxBytes:
+            return
+        self.__entries[key] = (value,size)
+        self.bytes += size
+        while len(self.__entries) > self.maxItems or self.bytes > self.maxBytes:
+            self.bytes -= self.__entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    ##
+    #  \brief counters for tuning
+    #  \return dict of hits, misses, evictions, items and bytes
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "items": len(self.__entries), "bytes": self.bytes}
+
+##
+#  \brief prefix completion of keys ranked by weight
+#
+#  The lowercased keys are kept in a sorted list: the keys of a prefix are
+#  a slice found with bisect, the heaviest ones are picked with heapq.
+#  Results of prefixes matching many keys are memoized until the next
+#  change.  Keys are any unicode strings, Chinese included.  search()
+#  finds substrings in all the keys joined into one string.
+class PrefixIndex(object):
+    ## slices longer than this are memoized
+    MEMO = 256
+
+    ##
+    #  \param items iterable of (key, id, weight)
+    def __init__(self,items=()):
+        self.__key = {}
+        self.__weight = {}
+        pairs = []
+        for key,id,weight in items:
+            self.__key[id] = key
+            self.__weight[id] = weight
+            pairs.append((key.lower(),id))
+        pairs.sort()
+        self.__lower = [pair[0] for pair in pairs]
+        self.__ids = [pair[1] for pair in pairs]
+        self.__memo = {}
+        self.__joined = None
+
+    def __len__(self):
+        return len(self.__ids)
+
+    ##
+    #  \brief add a key, or set the weight of a known one
+    def add(self,key,id,weight=0):
+        if id in self.__key:
+            self.setWeight(id,weight)
+            return
+        lower = key.lower()
+        pos = bisect_left(self.__lower,lower)
+        self.__lower.insert(pos,lower)
+        self.__ids.insert(pos,id)
+        self.__key[id] = key
+        self.__weight[id] = weight
+        self.__memo.clear()
+        self.__joined = None
+
+    ##
+    #  \brief remove a key by id, unknown ids are ignored
+    def remove(self,id):
+        key = self.__key.pop(id,None)
+        if key is None:
+            return
+        del self.__weight[id]
+        pos = bisect_left(self.__lower,key.lower())
+        while self.__ids[pos] != id:
+            pos += 1
+        del self.__lower[pos]
+        del self.__ids[pos]
+        self.__memo.clear()
+        self.__joined = None
+
+    ##
+    #  \brief change the weight of a key, unknown ids are ignored
+    def addWeight(self,id,delta):
+        if id in self.__weight:
+            self.__weight[id] += delta
+            self.__memo.clear()
+
+    ##
+    #  \brief set the weight of a key, unknown ids are ignored
+    def setWeight(self,id,weight):
+        if id in self.__weight:
+            self.__weight[id] = weight
+            self.__memo.clear()
+
+    ##
+    #  \brief keys starting with a prefix, case is ignored
+    #  \param prefix beginning of the keys
+    #  \param limit maximum number of keys
+    #  \return list of (key, weight), heaviest first, keys of weight <= 0 skipped
+    def complete(self,prefix,limit=10):
+        prefix = prefix.lower()
+        lo = bisect_left(self.__lower,prefix)
+        hi = bisect_left(self.__lower,prefix+u"\uffff",lo)
+        if hi-lo > self.MEMO:
+            found = self.__memo.get((prefix,limit))
+            if found is None:
+                found = self.__memo[(prefix,limit)] = self.__rank(self.__ids[lo:hi],limit)
+            return list(found)
+        return self.__rank(self.__ids[lo:hi],limit)
+
+    ##
+    #  \brief keys containing a string anywhere, case is ignored
+    #
+    #  All keys are scanned, use it as the fallback of complete().
+    def search(self,part,limit=10):
+        part = part.lower()
+        if not part or "\n" in part:
+            return []
+        if self.__joined is None:
+            starts = []
+            pos = 0
+            for lower in self.__lower:
+                starts.append(pos)
+                pos += len(lower)+1
+            self.__joined = (u"\n".join(self.__lower),starts)
+        joined,starts = self.__joined
+        ids = []
+        pos = joined.find(part)
+        while pos >= 0:
+            ii = bisect_right(starts,pos)-1
+            ids.append(self.__ids[ii])
+            if ii+1 == len(starts):
+                break
+            pos = joined.find(part,starts[ii+1])
+        return self.__rank(ids,limit)
+
+    def __rank(self,ids,limit):
+        weight = self.__weight
+        best = heapq.nsmallest(limit,(id for id in ids if weight[id] > 0),
+                               key=lambda id: (-weight[id],self.__key[id]))
+        return [(self.__key[id],weight[id]) for id in best]